@@ -1,3 +1,5 @@
+import asyncio
+
 from aiohttp import web
 
 from app.middlewares import disable_caching, server_timing
@@ -5,16 +7,22 @@ from utils import redirect
 
 from .api import api
 from .api.sse.handlers import sse_api
+from .core.analytics import aggregator
 from .models import init
 
-from config import DB, DB_OPTIONS
+from config import DB, DB_POOL, DB_OPTIONS, EVENTS_CONFIG
 
 
 async def startup(app):
-    await init(DB, **DB_OPTIONS)
+    sse_api.configure(**EVENTS_CONFIG)
+    await init(DB, pool=DB_POOL, **DB_OPTIONS)
+    await sse_api.connect()
+    app['aggregator'] = asyncio.ensure_future(aggregator())
 
 
 async def shutdown(app):
+    app['aggregator'].cancel()
+    await asyncio.gather(app['aggregator'], return_exceptions=True)
     await sse_api.stop()
 
 
@@ -1,20 +1,20 @@
 from aiohttp import web
 
-from app.models.analytics import users_stats
-from utils import json_dumps
-
-from .middlewares import errors_handling
+from .middlewares import errors_handling, db_session
 
 from .messages import messages_subapp
 from .media import media_subapp
 from .users import users_subapp
 from .auth import auth_subapp
 from .sse import sse_subapp
+from .stats import stats_subapp
+from .ws import ws_subapp
 from .test import test_subapp
 
 
 api = web.Application(middlewares=[
-    errors_handling
+    errors_handling,
+    db_session
 ])
 
 api.add_subapp("/messages/", messages_subapp)
@@ -22,34 +22,6 @@ api.add_subapp("/media/", media_subapp)
 api.add_subapp("/users/", users_subapp)
 api.add_subapp("/auth/", auth_subapp)
 api.add_subapp("/events/", sse_subapp)
+api.add_subapp("/stats/", stats_subapp)
+api.add_subapp("/ws/", ws_subapp)
 api.add_subapp("/test/", test_subapp)
-
-
-async def stats(request: web.Request) -> web.Response:
-    raw_stats = await users_stats()
-    general = raw_stats["general"]
-    exact = raw_stats["exact"]
-    stats = {
-        "general": {
-            "sended": {
-                "avg": general.sended_avg,
-                "median": general.sended_med
-            },
-            "received": {
-                "avg": general.received_avg,
-                "median": general.received_med
-            },
-        },
-        "exact": [
-            {
-                "id": row.User.id,
-                "username": row.User.username,
-                "sended": row.sended,
-                "received": row.received
-            } for row in exact
-        ]
-    }
-    return web.json_response(stats, dumps=json_dumps)
-
-
-api.router.add_get("/stats", stats)
@@ -3,6 +3,7 @@ from aiohttp import streamer
 
 from app.utils import server_timing
 from app.core.auth import auth_required
+from app.api.middlewares import read_only
 from app.core import media
 
 
@@ -35,6 +36,7 @@ async def store(request: web.Request):
 
 
 # @auth_required
+@read_only
 async def load(request: web.Request):
     data = request.rel_url.query
     message_id = data.get('message')
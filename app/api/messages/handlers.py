@@ -2,11 +2,14 @@ from aiohttp import web
 
 from app.utils import is_empty
 from app.core.auth import auth_required
-from app.core.messages import delete, edit, store_pm, get_pms
+from app.api.middlewares import read_only
+from app.core.messages import delete, edit, store_pm, get_history
 from app.core.messages import create_conference
-from app.core.messages import overview_pms
+from app.core.messages import overview_pms, read_pms
+from app.core.messages import search_pms
 
 
+@read_only
 @auth_required
 async def get_messages(request: web.Request):
     data = await request.json()
@@ -15,13 +18,37 @@ async def get_messages(request: web.Request):
     offset = data.get('offset', 0)
     count = data.get('count', 100)
     chat_type = data.get('chat_type', 1)
+    cursor = data.get('cursor')
+    before = data.get('before')
+    after = data.get('after')
     if chat_id is None:
         raise ValueError('missing user_id')
     chat_id, offset, count = map(int, (chat_id, offset, count))
-    messages = await get_pms(user_id, chat_id, offset, count, chat_type)
+    messages, next_cursor = await get_history(
+        user_id, chat_id, chat_type, offset, count, cursor, before, after
+    )
     return web.json_response({
         "status": 0,
-        "result": messages
+        "result": messages,
+        "next": next_cursor
+    })
+
+
+@read_only
+@auth_required
+async def search_messages(request: web.Request):
+    data = await request.json()
+    user_id = request['user_id']
+    text = data.get('text')
+    count = int(data.get('count', 20))
+    cursor = data.get('cursor')
+    if not isinstance(text, str) or is_empty(text):
+        raise ValueError('text is missing or incorrect')
+    messages, next_cursor = await search_pms(user_id, text, count, cursor)
+    return web.json_response({
+        "status": 0,
+        "result": messages,
+        "next": next_cursor
     })
 
 
@@ -76,6 +103,7 @@ async def delete_message(request: web.Request) -> web.Response:
     })
 
 
+@read_only
 @auth_required
 async def get_chats(request: web.Request):
     user_id = request['user_id']
@@ -85,6 +113,20 @@ async def get_chats(request: web.Request):
     })
 
 
+@auth_required
+async def read_messages(request: web.Request) -> web.Response:
+    data = await request.json()
+    user_id = request['user_id']
+    chat_id = data.get('user_id')
+    chat_type = data.get('chat_type', 1)
+    if chat_id is None:
+        raise ValueError('missing user_id')
+    await read_pms(user_id, int(chat_id), int(chat_type))
+    return web.json_response({
+        "status": 0
+    })
+
+
 @auth_required
 async def create_conversation(request: web.Request):
     data = await request.json()
@@ -6,6 +6,8 @@ from .handlers import edit_message
 from .handlers import delete_message
 from .handlers import create_conversation
 from .handlers import get_chats
+from .handlers import read_messages
+from .handlers import search_messages
 
 
 dispatcher = web.UrlDispatcher()
@@ -16,3 +18,5 @@ dispatcher.add_post('/edit', edit_message)
 dispatcher.add_post('/delete', delete_message)
 dispatcher.add_post('/create_conversation', create_conversation)
 dispatcher.add_post('/overview', get_chats)
+dispatcher.add_post('/read', read_messages)
+dispatcher.add_post('/search', search_messages)
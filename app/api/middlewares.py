@@ -1,8 +1,12 @@
 import traceback
+from functools import wraps
+from typing import Callable, Hashable, NamedTuple, Optional
 
 from aiohttp import web
 
 from app.middlewares import Handler
+from app.models import request_session
+from utils.cache import TTLCache, cached
 
 
 @web.middleware
@@ -27,3 +31,100 @@ async def errors_handling(
             },
             status=status_code
         )
+
+
+@web.middleware
+async def db_session(
+    request: web.Request,
+    handler: Handler
+) -> web.Response:
+    """
+    Runs a request with it's own DB session, so all DB calls of the request
+    share one connection. Session is committed after handler if it's not
+    marked as read-only and is stored in request's 'db_session' attribute.
+    """
+    route_handler = request.match_info.handler
+    if getattr(route_handler, "without_session", False):
+        return await handler(request)
+    read_only = getattr(route_handler, "read_only", False)
+    async with request_session(read_only=read_only) as session:
+        request['db_session'] = session
+        return await handler(request)
+
+
+def read_only(handler: Handler) -> Handler:
+    """
+    Marks a handler which doesn't change DB: it's request session runs
+    read-only transaction and isn't committed.
+    """
+    handler.read_only = True
+    return handler
+
+
+def without_session(handler: Handler) -> Handler:
+    """
+    Marks a handler which mustn't hold a request session for it's whole
+    lifetime (e.g. streaming events), so each of it's DB calls uses it's own
+    short session.
+    """
+    handler.without_session = True
+    return handler
+
+
+class CachedResponse(NamedTuple):
+
+    status: int
+    content_type: str
+    body: bytes
+
+
+def cached_response(
+    ttl: float = 5.0,
+    stale: float = 60.0,
+    per_user: bool = False,
+    key: Optional[Callable[[web.Request], Hashable]] = None,
+    maxsize: int = 256
+) -> Callable[[Handler], Handler]:
+    """
+    Caches bodies of handler's responses by request's path and query (and
+    user, if 'per_user' is set) for 'ttl' seconds. Concurrent requests which
+    missed cache wait for one call of handler, and for 'stale' seconds after
+    expiration cached response is served while handler runs in background.
+
+    Handler runs with it's own DB session (read-only if it's marked so), as
+    background refresh outlives the request; per-user handlers must be
+    wrapped by 'auth_required' outside of this decorator.
+    """
+
+    def make_key(request: web.Request) -> Hashable:
+        if per_user:
+            return request['user_id'], request.rel_url.path_qs
+        return request.rel_url.path_qs
+
+    def wrapper(handler: Handler) -> Handler:
+        read_only = getattr(handler, "read_only", False)
+        cache = TTLCache(maxsize, ttl, stale=stale)
+
+        @cached(cache, key=key or make_key)
+        async def render(request: web.Request) -> CachedResponse:
+            async with request_session(read_only=read_only) as session:
+                request['db_session'] = session
+                response = await handler(request)
+            return CachedResponse(
+                response.status, response.content_type, response.body
+            )
+
+        @wraps(handler)
+        async def wrapped(request: web.Request) -> web.Response:
+            response = await render(request)
+            return web.Response(
+                status=response.status,
+                content_type=response.content_type,
+                body=response.body
+            )
+
+        wrapped.without_session = True
+        wrapped.cache = cache
+        return wrapped
+
+    return wrapper
@@ -1,28 +1,110 @@
 import asyncio
+import socket
 
 from aiohttp import web
 from aiohttp_sse import sse_response
 
 from app.core.sse import ServerSentEventsAPI
 from app.core.auth import sse_auth_required
+from app.core.events.events import PollingStart, PollingRequest, PollingEnd
+from app.api.middlewares import without_session
 
 
 sse_api = ServerSentEventsAPI()
 
+# Seconds between heartbeats of idle streams and max seconds for which peer
+#  may not accept sent data, after it stream is considered dead
+HEARTBEAT = 15.0
+WRITE_TIMEOUT = 20.0
 
+# Heartbeat is a comment, clients ignore it
+PING = b": ping\r\n\r\n"
+
+# Default and max seconds for which poll waits for events
+POLL_TIMEOUT = 25.0
+MAX_POLL_TIMEOUT = 60.0
+
+
+def set_user_timeout(request: web.Request, timeout: float) -> None:
+    """
+    Makes OS close connection when sent data isn't acknowledged by peer for
+    'timeout' seconds (if OS supports it), so dead peers behind NAT are found
+    by heartbeats without waiting for TCP retransmissions to give up.
+    """
+    transport = request.transport
+    if transport is None or not hasattr(socket, 'TCP_USER_TIMEOUT'):
+        return
+    sock = transport.get_extra_info('socket')
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(timeout * 1000)
+        )
+    except OSError:  # not a TCP socket
+        pass
+
+
+@without_session
 @sse_auth_required
 async def all_events(request: web.Request):
     user_id: int = request["user_id"]
-    events_queue: asyncio.Queue = sse_api.get_events_queue(user_id)
-    async with sse_response(request) as resp:
-        while True:
-            try:
-                event = await events_queue.get()  # CancelledError
-            except asyncio.CancelledError:
-                break
-            else:
-                body = event.as_json()
-                e_type = event.__class__.__name__
-                await resp.send(body, event=e_type)
-    await sse_api.del_events_queue(user_id, events_queue)
+    events_queue: asyncio.Queue = await sse_api.get_events_queue(
+        user_id, request.headers.get('Last-Event-ID')
+    )
+    try:
+        async with sse_response(request) as resp:
+            # Library's pings can't find dead peers, heartbeats are sent here
+            resp.stop_streaming()
+            set_user_timeout(request, WRITE_TIMEOUT)
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        events_queue.get(), HEARTBEAT
+                    )
+                    events = await events_queue.batch(event)
+                except asyncio.TimeoutError:
+                    data = PING
+                except asyncio.CancelledError:
+                    break
+                else:
+                    # Batch is written by one call (and usually one packet)
+                    data = b"".join(event.as_sse() for event in events)
+                try:
+                    await asyncio.wait_for(resp.write(data), WRITE_TIMEOUT)
+                except (asyncio.TimeoutError, ConnectionResetError):
+                    # Peer doesn't read stream, connection is dropped and
+                    #  its listener is reaped
+                    if request.transport is not None:
+                        request.transport.abort()
+                    break
+                # Queue is closed by overflow and client must reconnect
+                if events_queue.closed and events_queue.empty():
+                    break
+    finally:
+        await sse_api.del_events_queue(user_id, events_queue)
     return resp
+
+
+@without_session
+@sse_auth_required
+async def poll_events(request: web.Request):
+    """
+    Long-poll for clients which can't receive SSE: returns all events
+    following 'cursor' as soon as any of them arrive (or an empty list after
+    'timeout' seconds) with cursor for the next poll.
+    """
+    user_id: int = request["user_id"]
+    cursor = request.query.get('cursor')
+    timeout = float(request.query.get('timeout', POLL_TIMEOUT))
+    timeout = min(max(timeout, 0), MAX_POLL_TIMEOUT)
+    if cursor is None:
+        await PollingStart.emit(user_id)
+    await PollingRequest.emit(user_id, cursor)
+    events, next_cursor = await sse_api.poll(user_id, cursor, timeout)
+    await PollingEnd.emit(user_id, len(events))
+    # Events are encoded once for all transports
+    body = '{{"status": 0, "cursor": "{}", "result": [{}]}}'.format(
+        next_cursor, ", ".join(event.as_ws() for event in events)
+    )
+    return web.Response(text=body, content_type='application/json')
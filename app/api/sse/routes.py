@@ -1,9 +1,10 @@
 from aiohttp import web
 
-from .handlers import all_events
+from .handlers import all_events, poll_events
 
 
 dispatcher = web.UrlDispatcher()
 
 dispatcher.add_get('/', all_events)
 dispatcher.add_get('/all', all_events)
+dispatcher.add_get('/poll', poll_events)
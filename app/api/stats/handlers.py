@@ -0,0 +1,103 @@
+from time import time
+
+from aiohttp import web
+
+from app.core import analytics
+from app.core.users import users_cache
+from app.api.sse.handlers import sse_api
+from app.api.middlewares import read_only, without_session, cached_response
+from app.models.analytics import PERIODS, users_stats
+from utils import json_dumps
+
+
+def get_range(request: web.Request):
+    """
+    Extracts period and range of buckets from query (last 30 buckets by
+    default).
+    """
+    params = request.query
+    period = params.get('period', 'day')
+    if period not in PERIODS:
+        raise ValueError('unknown period')
+    end = float(params.get('end', time()))
+    start = params.get('start')
+    if start is None:
+        start = end - 30 * PERIODS[period].total_seconds()
+    return period, float(start), end
+
+
+# Statistics are recomputed at most once per this number of seconds
+STATS_TTL = 10.0
+
+# Rollups change only when aggregator runs
+ACTIVITY_TTL = 30.0
+
+
+@cached_response(ttl=STATS_TTL)
+@read_only
+async def get_users(request: web.Request):
+    raw_stats = await users_stats()
+    general = raw_stats["general"]
+    exact = raw_stats["exact"]
+    stats = {
+        "general": {
+            "sended": {
+                "avg": general.sended_avg,
+                "median": general.sended_med
+            },
+            "received": {
+                "avg": general.received_avg,
+                "median": general.received_med
+            },
+        },
+        "exact": [
+            {
+                "id": row.User.id,
+                "username": row.User.username,
+                "sended": row.sended,
+                "received": row.received
+            } for row in exact
+        ]
+    }
+    return web.json_response(stats, dumps=json_dumps)
+
+
+@cached_response(ttl=ACTIVITY_TTL)
+@read_only
+async def get_activity(request: web.Request):
+    period, start, end = get_range(request)
+    chat_type = int(request.query.get('chat_type', 0))
+    chat = int(request.query.get('chat', 0))
+    buckets = await analytics.activity(period, start, end, chat_type, chat)
+    return web.json_response({
+        "status": 0,
+        "result": buckets
+    }, dumps=json_dumps)
+
+
+@cached_response(ttl=ACTIVITY_TTL)
+@read_only
+async def get_conferences(request: web.Request):
+    period, start, end = get_range(request)
+    count = int(request.query.get('count', 20))
+    conferences = await analytics.conferences(period, start, end, count)
+    return web.json_response({
+        "status": 0,
+        "result": conferences
+    }, dumps=json_dumps)
+
+
+@without_session
+async def get_events(request: web.Request):
+    return web.json_response(sse_api.stats(), dumps=json_dumps)
+
+
+@without_session
+async def get_cache(request: web.Request):
+    return web.json_response({
+        "users": users_cache.stats(),
+        "responses": {
+            handler.__name__: handler.cache.stats()
+            for handler in (get_users, get_activity, get_conferences)
+        }
+    }, dumps=json_dumps)
@@ -0,0 +1,17 @@
+from aiohttp import web
+
+from .handlers import get_users
+from .handlers import get_activity
+from .handlers import get_conferences
+from .handlers import get_events
+from .handlers import get_cache
+
+
+dispatcher = web.UrlDispatcher()
+
+# Users statistics are served by the root of subapp ('/api/stats')
+dispatcher.add_get('', get_users)
+dispatcher.add_get('/activity', get_activity)
+dispatcher.add_get('/conferences', get_conferences)
+dispatcher.add_get('/events', get_events)
+dispatcher.add_get('/cache', get_cache)
@@ -33,8 +33,8 @@ class Chat(web.View, metaclass=ExtractionMeta):
                     },
                     'message': {
                         'sender': chat.sender,
-                        'text': chat.Message.text,
-                        'sent': chat.Message.time_sent.timestamp(),
+                        'text': chat.preview,
+                        'sent': chat.last_activity.timestamp(),
                     }
                 } for chat in chat_rows
             ]
@@ -3,8 +3,10 @@ from aiohttp import web
 from app.core import users
 from errors import UserDoesntExists
 from app.core.auth import auth_required
+from app.api.middlewares import read_only
 
 
+@read_only
 @auth_required
 async def get_self(request: web.Request):
     user = request['user']
@@ -18,6 +20,7 @@ async def get_self(request: web.Request):
     })
 
 
+@read_only
 @auth_required
 async def get_by_id(request: web.Request):
     data = await request.json()
@@ -38,6 +41,7 @@ async def get_by_id(request: web.Request):
     })
 
 
+@read_only
 @auth_required
 async def explore_users(request: web.Request):
     users = {}  # await db.get_users()
@@ -47,14 +51,18 @@ async def explore_users(request: web.Request):
     })
 
 
+@read_only
 @auth_required
 async def search_user(request: web.Request):
     data = await request.post()
     username = data.get('username')
     if username is None or not username:
         raise ValueError('username is missing or incorrect')
-    userlist = await users.search(username)
+    count = int(data.get('count', users.SEARCH_LIMIT))
+    cursor = data.get('cursor')
+    userlist, next_cursor = await users.search(username, count, cursor)
     return web.json_response({
         "status": 0,
-        "result": dict(userlist)
+        "result": userlist,
+        "next": next_cursor
     })
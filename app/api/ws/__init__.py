@@ -0,0 +1,6 @@
+from aiohttp import web
+
+from .routes import dispatcher
+
+
+ws_subapp = web.Application(router=dispatcher)
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, NamedTuple
+
+from aiohttp import web, WSMsgType
+
+from app.utils import is_empty
+from app.core.auth import sse_auth_required
+from app.core.messages import delete, edit, store_pm, get_history
+from app.core.messages import overview_pms, read_pms, search_pms
+from app.api.middlewares import without_session
+from app.api.sse.handlers import sse_api
+from app.models import request_session
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between pings of client
+HEARTBEAT = 30
+
+
+class Action(NamedTuple):
+
+    handler: Callable[[int, dict], Awaitable]
+    read_only: bool
+
+
+async def send_message(user_id: int, data: dict):
+    to_id = int(data.get('to'))
+    text = data.get('text', '')
+    attachments = [int(attach) for attach in data.get('attachments', ())]
+    chat_type = int(data.get('chat_type', 1))
+    if is_empty(text) and not attachments:
+        raise ValueError('empty message')
+    message, id, _ = await store_pm(
+        user_id, to_id, text, attachments, chat_type
+    )
+    return {
+        "id": id,
+        "sent": message.time_sent.timestamp()
+    }
+
+
+async def edit_message(user_id: int, data: dict):
+    chat_id = data.get('user_id')
+    if chat_id is None:
+        raise ValueError('missing user_id')
+    text = data.get('text', '').strip()
+    chat_type = data.get('chat_type', 1)
+    await edit(
+        user_id, chat_id, data.get('message_id'), text, chat_type=chat_type
+    )
+
+
+async def delete_message(user_id: int, data: dict):
+    chat_id = data.get('user_id')
+    if chat_id is None:
+        raise ValueError('missing user_id')
+    chat_type = data.get('chat_type', 1)
+    await delete(user_id, chat_id, data.get('message_id'), chat_type)
+
+
+async def get_messages(user_id: int, data: dict):
+    chat_id = data.get('user_id')
+    if chat_id is None:
+        raise ValueError('missing user_id')
+    messages, next_cursor = await get_history(
+        user_id,
+        int(chat_id),
+        data.get('chat_type', 1),
+        int(data.get('offset', 0)),
+        int(data.get('count', 100)),
+        data.get('cursor'),
+        data.get('before'),
+        data.get('after')
+    )
+    return {
+        "messages": messages,
+        "next": next_cursor
+    }
+
+
+async def get_chats(user_id: int, data: dict):
+    return await overview_pms(user_id)
+
+
+async def read_messages(user_id: int, data: dict):
+    chat_id = data.get('user_id')
+    if chat_id is None:
+        raise ValueError('missing user_id')
+    await read_pms(user_id, int(chat_id), int(data.get('chat_type', 1)))
+
+
+async def search_messages(user_id: int, data: dict):
+    text = data.get('text')
+    if not isinstance(text, str) or is_empty(text):
+        raise ValueError('text is missing or incorrect')
+    messages, next_cursor = await search_pms(
+        user_id, text, int(data.get('count', 20)), data.get('cursor')
+    )
+    return {
+        "messages": messages,
+        "next": next_cursor
+    }
+
+
+# Actions of socket's requests, their data is the same as data of the
+#  respective HTTP API requests
+ACTIONS: Dict[str, Action] = {
+    "send": Action(send_message, False),
+    "edit": Action(edit_message, False),
+    "delete": Action(delete_message, False),
+    "get": Action(get_messages, True),
+    "overview": Action(get_chats, True),
+    "read": Action(read_messages, False),
+    "search": Action(search_messages, True),
+}
+
+
+async def perform(user_id: int, raw_request: str) -> dict:
+    """
+    Performs socket's request ('{"id": ..., "action": ..., "data": {...}}')
+    with it's own DB session. Returns a response with the same id.
+    """
+    request_id = None
+    try:
+        request = json.loads(raw_request)
+        if not isinstance(request, dict):
+            raise ValueError('request must be an object')
+        request_id = request.get('id')
+        action = ACTIONS.get(request.get('action'))
+        if action is None:
+            raise ValueError('unknown action')
+        data = request.get('data') or {}
+        if not isinstance(data, dict):
+            raise ValueError('data must be an object')
+        async with request_session(read_only=action.read_only):
+            result = await action.handler(user_id, data)
+    except Exception as e:
+        if not isinstance(e, (ValueError, TypeError)):
+            logger.exception("Socket's request failed")
+        return {
+            "id": request_id,
+            "status": 1,
+            "error": e.__class__.__name__,
+            "description": str(e)
+        }
+    return {
+        "id": request_id,
+        "status": 0,
+        "result": result
+    }
+
+
+async def send_events(ws: web.WebSocketResponse, events_queue) -> None:
+    while True:
+        event = await events_queue.get()
+        await ws.send_str(event.as_ws())
+        # Queue is closed by overflow and client must reconnect
+        if events_queue.closed and events_queue.empty():
+            await ws.close()
+            break
+
+
+@without_session
+@sse_auth_required
+async def websocket(request: web.Request):
+    """
+    Socket which multiplexes user's requests (see ACTIONS) and events.
+    Requests are performed in order of receiving.
+    """
+    user_id: int = request["user_id"]
+    ws = web.WebSocketResponse(heartbeat=HEARTBEAT)
+    await ws.prepare(request)
+    events_queue = await sse_api.get_events_queue(
+        user_id, request.query.get('last_event_id')
+    )
+    sender = asyncio.ensure_future(send_events(ws, events_queue))
+    try:
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            response = await perform(user_id, message.data)
+            await ws.send_str(json.dumps(response))
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        await sse_api.del_events_queue(user_id, events_queue)
+    return ws
@@ -0,0 +1,10 @@
+from aiohttp import web
+
+from .handlers import websocket
+
+
+dispatcher = web.UrlDispatcher()
+
+# Socket is served by the root of subapp ('/api/ws')
+dispatcher.add_get('', websocket)
+dispatcher.add_get('/', websocket)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from datetime import datetime as dt
+from typing import Optional
+
+from app.models.analytics import aggregate_activity
+from app.models.analytics import messages_stats, conferences_stats
+from app.models.analytics import buckets_range
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between aggregations of new messages and uploads into rollups
+AGGREGATION_INTERVAL = 60
+
+# Max number of buckets returned by one activity request
+MAX_BUCKETS = 1000
+
+
+async def aggregator(interval: float = AGGREGATION_INTERVAL):
+    """
+    Keeps activity rollups up to date. Backlog (e.g. history of messages
+    sent before rollups were added) is aggregated by batches without pauses.
+    """
+    while True:
+        try:
+            while await aggregate_activity():
+                pass
+        except Exception:
+            logger.exception("Activity aggregation failed")
+        await asyncio.sleep(interval)
+
+
+async def activity(
+    period: str,
+    start: float,
+    end: float,
+    chat_type: int = 0,
+    chat: int = 0
+) -> list:
+    start, end = dt.fromtimestamp(start), dt.fromtimestamp(end)
+    buckets_range(period, start, end, MAX_BUCKETS)
+    rows = await messages_stats(period, start, end, chat_type, chat)
+    return [
+        {
+            "bucket": row.bucket.timestamp(),
+            "messages": row.messages,
+            "attachments": row.attachments,
+            "attachments_size": row.attachments_size,
+            "uploads": row.uploads,
+            "uploads_size": row.uploads_size,
+            "active_users": row.active_users
+        } for row in rows
+    ]
+
+
+async def conferences(
+    period: str,
+    start: float,
+    end: float,
+    count: Optional[int] = None
+) -> list:
+    start, end = dt.fromtimestamp(start), dt.fromtimestamp(end)
+    buckets_range(period, start, end, MAX_BUCKETS)
+    rows = await conferences_stats(period, start, end, count)
+    return [
+        {
+            "id": row.id,
+            "username": row.username,
+            "title": row.title,
+            "messages": row.messages,
+            "attachments": row.attachments,
+            "attachments_size": row.attachments_size
+        } for row in rows
+    ]
@@ -0,0 +1,192 @@
+"""
+Module with brokers of events: they deliver events emitted by any process
+of server to events APIs of all processes.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Type
+
+import asyncpg
+
+from .events.event_mixin import EventMixin
+
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[EventMixin], None]
+
+# Max size of NOTIFY payload is 8000 bytes, part of it is left for header
+NOTIFY_PAYLOAD_SIZE = 7900
+
+# Seconds for which published events are collected into one batch
+BATCH_DELAY = 0.005
+
+# Max number of events waiting for publishing while DB is unavailable
+MAX_PENDING = 10000
+
+# Seconds between reconnects to DB
+RECONNECT_DELAY = 1.0
+
+
+class Broker:
+    """
+    Base class of brokers. Broker passes published events to 'deliver'
+    function of every process (including the publishing one). Events are
+    published by direct handlers, so 'publish' mustn't block.
+    """
+
+    def __init__(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def start(self) -> None:
+        pass
+
+    def publish(self, event: EventMixin) -> None:
+        raise NotImplementedError
+
+    async def stop(self) -> None:
+        pass
+
+
+class InMemoryBroker(Broker):
+    """
+    Broker of a single process.
+    """
+
+    def publish(self, event: EventMixin) -> None:
+        self.deliver(event)
+
+
+class PostgresBroker(Broker):
+    """
+    Broker which sends events to other processes by Postgres notifications.
+
+    Events are delivered to own process at once and are published by
+    batches: events collected for BATCH_DELAY seconds are sent by one NOTIFY
+    (or several ones, if they don't fit into payload). Notification's payload
+    is a header line ('<origin> <batch> <part> <parts>') and a part of JSON
+    list of events; parts of a batch are joined by receivers.
+    """
+
+    def __init__(
+        self,
+        deliver: Deliver,
+        dsn: str,
+        event_types: Dict[str, Type[EventMixin]],
+        channel: str = "microchat_events"
+    ):
+        super().__init__(deliver)
+        self.dsn = dsn
+        self.event_types = event_types
+        self.channel = channel
+        # Process' own notifications are recognized by origin
+        self.origin = uuid.uuid4().hex
+        self.pending: List[dict] = []
+        self.batches = 0
+        self.parts: Dict[str, List[str]] = {}
+        self.wakeup = asyncio.Event()
+        self.connected = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.task = asyncio.ensure_future(self.run())
+        await self.connected.wait()
+
+    def publish(self, event: EventMixin) -> None:
+        self.deliver(event)
+        if len(self.pending) >= MAX_PENDING:
+            del self.pending[0]
+            logger.warning("Events broker is overloaded, event is dropped")
+        message = {
+            "type": type(event).__name__,
+            "fields": asdict(event)
+        }
+        if event.recipients is not None:
+            message["recipients"] = event.recipients
+        self.pending.append(message)
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+            except (OSError, asyncpg.PostgresError):
+                logger.exception("Events broker can't connect to DB")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await conn.add_listener(self.channel, self.receive)
+                self.connected.set()
+                while True:
+                    await self.wakeup.wait()
+                    await asyncio.sleep(BATCH_DELAY)
+                    self.wakeup.clear()
+                    await self.flush(conn)
+            except (OSError, asyncpg.PostgresError,
+                    asyncpg.InterfaceError):
+                logger.exception("Events broker lost connection to DB")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await conn.close(timeout=1)
+
+    async def flush(self, conn: asyncpg.Connection) -> None:
+        events, self.pending = self.pending, []
+        if not events:
+            return
+        self.batches += 1
+        data = json.dumps(events)
+        size = NOTIFY_PAYLOAD_SIZE
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        try:
+            for part, chunk in enumerate(chunks):
+                header = "{} {} {} {}".format(
+                    self.origin, self.batches, part, len(chunks)
+                )
+                await conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    self.channel, header + "\n" + chunk
+                )
+        except BaseException:
+            # Batch is sent again after reconnect
+            self.pending[:0] = events
+            self.wakeup.set()
+            raise
+
+    def receive(self, conn, pid: int, channel: str, payload: str) -> None:
+        header, chunk = payload.split("\n", 1)
+        origin, batch, part, parts = header.split(" ")
+        if origin == self.origin:
+            return
+        if parts != "1":
+            # Parts of batch are sent one by one by one connection, so
+            #  they're received in order
+            key = origin + batch
+            chunks = self.parts.setdefault(key, [])
+            if part == "0":
+                chunks.clear()
+            chunks.append(chunk)
+            if int(part) < int(parts) - 1:
+                return
+            chunk = "".join(self.parts.pop(key))
+        for event in json.loads(chunk):
+            event_type = self.event_types.get(event["type"])
+            if event_type is None:
+                logger.warning("Unknown event type: %s", event["type"])
+                continue
+            restored = event_type.restore(event["fields"])
+            if "recipients" in event:
+                restored.recipients = tuple(event["recipients"])
+            self.deliver(restored)
+            # Event's own handlers (e.g. caches invalidation) run in every
+            #  process, but it isn't published again
+            restored.handle(direct=False)
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
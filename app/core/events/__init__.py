@@ -7,7 +7,8 @@ from .events import ChatCreate, ChatDelete
 from .events import ChatsRequest
 from .events import NewUser
 from .events import UserOnline, UserOffline
-from .events import UserDelete
+from .events import UserChanged, UserDelete
 from .events import SSEStart, SSEEnd
+from .events import Resync
 from .events import PollingStart, PollingEnd
 from .events import PollingRequest
@@ -1,25 +1,124 @@
 import asyncio
 import json
+import logging
 from dataclasses import asdict
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+def handler_name(handler: Callable) -> str:
+    return getattr(handler, "__qualname__", repr(handler))
 
 
 class EventMixin:
 
     __handlers__: set
 
+    # Synchronous handlers which are called when event is made
+    __direct_handlers__: tuple = ()
+
+    # Id of event in events streams, it's given on dispatch
+    event_id = None
+
+    # Users which event is routed to if they aren't known from its fields,
+    #  they aren't serialized into event's data
+    recipients = None
+
     def emit(self, *args, **kwargs):
         raise NotImplementedError
 
     def as_json(self):
-        return json.dumps(asdict(self))
+        # Event is sent to many listeners, so it's serialized once
+        serialized = self.__dict__.get("_json")
+        if serialized is None:
+            serialized = self._json = json.dumps(asdict(self))
+        return serialized
+
+    def as_sse(self) -> bytes:
+        """
+        Gets event framed as a server-sent event ('id', 'event' and 'data'
+        fields) which can be written to any events stream as is.
+        """
+        payload = self.__dict__.get("_sse")
+        if payload is None:
+            lines = []
+            if self.event_id is not None:
+                lines.append("id: {}".format(self.event_id))
+            lines.append("event: {}".format(type(self).__name__))
+            lines.append("data: {}".format(self.as_json()))
+            payload = self._sse = ("\r\n".join(lines) + "\r\n\r\n").encode()
+        return payload
+
+    def as_ws(self) -> str:
+        """
+        Gets event as a WebSocket message ('{"event": ..., "id": ...,
+        "data": ...}'), it's made of cached JSON without serializing again.
+        """
+        message = self.__dict__.get("_ws")
+        if message is None:
+            message = '{{"event": {}, "id": {}, "data": {}}}'.format(
+                json.dumps(type(self).__name__),
+                json.dumps(self.event_id),
+                self.as_json()
+            )
+            self._ws = message
+        return message
+
+    @classmethod
+    def restore(cls, fields: dict):
+        """
+        Makes an event of given fields without processing it by handlers
+        (e.g. an event received from other process, see 'handle').
+        """
+        event = cls.__new__(cls)
+        event.__dict__.update(fields)
+        return event
 
     @classmethod
     def add_handler(cls, handler):
         cls.__handlers__.add(handler)
 
+    @classmethod
+    def add_direct_handler(cls, handler: Callable[["EventMixin"], None]):
+        """
+        Adds a handler which is called in place when event is made, without
+        scheduling tasks, so it mustn't block. Errors of handler are logged
+        and don't stop other handlers.
+        """
+        handlers = cls.__dict__.get("__direct_handlers__", ())
+        cls.__direct_handlers__ = handlers + (handler,)
+
     async def process(self):
-        coros = [handler(self) for handler in self.__handlers__]
-        await asyncio.gather(*coros, return_exceptions=True)
+        handlers = list(self.__handlers__)
+        results = await asyncio.gather(
+            *(handler(self) for handler in handlers), return_exceptions=True
+        )
+        for handler, result in zip(handlers, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "Handler %s of %s failed", handler_name(handler),
+                    type(self).__name__, exc_info=result
+                )
+
+    def handle(self, direct: bool = True) -> None:
+        """
+        Runs event's handlers: direct ones in place and others in a task.
+        Event received from other process is handled without direct ones,
+        as they publish events to listeners, which is done by broker.
+        """
+        if direct:
+            for handler in self.__direct_handlers__:
+                try:
+                    handler(self)
+                except Exception:
+                    logger.exception(
+                        "Direct handler %s of %s failed",
+                        handler_name(handler), type(self).__name__
+                    )
+        if self.__handlers__:
+            asyncio.ensure_future(self.process())
 
     def __post_init__(self):
-        asyncio.ensure_future(self.process())
+        self.handle()
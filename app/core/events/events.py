@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 from aiohttp.web import Request
 
@@ -28,11 +29,32 @@ class SSEEnd(EventMixin):
         pass
 
 
+@dataclass
+class Resync(EventMixin):
+    """
+    Tells a client that some of its events were dropped, so it must reload
+    its chats. Client's stream is closed after this event.
+    """
+
+    reason: str
+
+    __handlers__ = set()
+
+
 @dataclass
 class PollingStart(EventMixin):
+    """
+    Client starts polling (its first poll has no cursor).
+    """
+
+    user_id: int
 
     __handlers__ = set()
 
+    @classmethod
+    async def emit(cls, user_id: int):
+        return cls(user_id)
+
     def from_request(self, request: Request):
         pass
 
@@ -40,16 +62,33 @@ class PollingStart(EventMixin):
 @dataclass
 class PollingRequest(EventMixin):
 
+    user_id: int
+    cursor: Optional[str] = None
+
     __handlers__ = set()
 
+    @classmethod
+    async def emit(cls, user_id: int, cursor: Optional[str] = None):
+        return cls(user_id, cursor)
+
     def from_request(self, request: Request):
         pass
 
 
 @dataclass
 class PollingEnd(EventMixin):
+    """
+    Poll is answered with given number of events.
+    """
+
+    user_id: int
+    events: int
 
     __handlers__ = set()
 
+    @classmethod
+    async def emit(cls, user_id: int, events: int):
+        return cls(user_id, events)
+
     def from_request(self, request: Request):
         pass
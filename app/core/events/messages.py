@@ -63,6 +63,7 @@ class MessageEdit(EventMixin):
     receiver: int
     message_id: int
     text: str
+    time_edit: int
     attachments: list
     chat_type: int = 1
 
@@ -84,9 +85,18 @@ class MessageEdit(EventMixin):
         receiver = kwargs.get('to', to)
         message_id = kwargs.get('id', id)
         text = kwargs.get('text', text)
+        time_edit = kwargs.get('time_edit')
         attachments = kwargs.get('attachments', attachments)
-        chat_type = kwargs.get('chat_type', 1)
-        return cls(sender, receiver, message_id, text, attachments, chat_type)
+        chat_type = kwargs.get('chat_type', chat_type)
+        return cls(
+            sender,
+            receiver,
+            message_id,
+            text,
+            time_edit,
+            attachments,
+            chat_type
+        )
 
 
 @dataclass
@@ -95,6 +105,7 @@ class MessageDelete(EventMixin):
     sender: int
     receiver: int
     message_id: int
+    chat_type: int = 1
 
     __handlers__ = set()
 
@@ -104,13 +115,15 @@ class MessageDelete(EventMixin):
         from_: int,
         to: int,
         id: int,
+        chat_type: int = 1,
         *args,
         **kwargs
     ):
         sender = kwargs.get('from_', from_)
         receiver = kwargs.get('to', to)
         message_id = kwargs.get('id', id)
-        return cls(sender, receiver, message_id)
+        chat_type = kwargs.get('chat_type', chat_type)
+        return cls(sender, receiver, message_id, chat_type)
 
 
 @dataclass
@@ -138,8 +151,8 @@ class ChatCreate(EventMixin):
     __handlers__ = set()
 
     @classmethod
-    async def emit(cls, request: Request):
-        pass
+    async def emit(cls, chat_id: int, chat_name: str, members: Iterable[int]):
+        return cls(chat_id, chat_name, tuple(members))
 
 
 @dataclass
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, InitVar
+from typing import Iterable, Optional
 
 from aiohttp.web import Request
 
@@ -18,8 +19,15 @@ class NewUser(EventMixin):  # OK
 @dataclass
 class UserChanged(EventMixin):  # OK
 
+    id: int
+    username: Optional[str] = None  # username before change
+
     __handlers__ = set()
 
+    @classmethod
+    async def emit(cls, id: int, username: Optional[str] = None, **kwargs):
+        return cls(id, username)
+
     @classmethod
     async def from_request(cls, request: Request):
         pass
@@ -28,8 +36,15 @@ class UserChanged(EventMixin):  # OK
 @dataclass
 class UserDelete(EventMixin):
 
+    id: int
+    username: Optional[str] = None
+
     __handlers__ = set()
 
+    @classmethod
+    async def emit(cls, id: int, username: Optional[str] = None, **kwargs):
+        return cls(id, username)
+
     @classmethod
     async def from_request(cls, request: Request):
         pass
@@ -38,8 +53,20 @@ class UserDelete(EventMixin):
 @dataclass
 class UserOnline(EventMixin):
 
+    id: int
+    # Users who are told about it, they aren't sent to clients
+    followers: InitVar[Iterable[int]] = ()
+
     __handlers__ = set()
 
+    def __post_init__(self, followers: Iterable[int]):
+        self.recipients = tuple(followers)
+        super().__post_init__()
+
+    @classmethod
+    async def emit(cls, id: int, followers: Iterable[int]):
+        return cls(id, followers)
+
     @classmethod
     async def from_request(cls, request: Request):
         pass
@@ -48,8 +75,19 @@ class UserOnline(EventMixin):
 @dataclass
 class UserOffline(EventMixin):
 
+    id: int
+    followers: InitVar[Iterable[int]] = ()
+
     __handlers__ = set()
 
+    def __post_init__(self, followers: Iterable[int]):
+        self.recipients = tuple(followers)
+        super().__post_init__()
+
+    @classmethod
+    async def emit(cls, id: int, followers: Iterable[int]):
+        return cls(id, followers)
+
     @classmethod
     async def from_request(cls, request: Request):
         pass
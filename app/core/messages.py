@@ -1,12 +1,16 @@
-from typing import Iterable, Optional
+import binascii
+import html
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import Iterable, Optional, Tuple
 
-from app.models import User, Message, Attachment, Conference
-from app.models import store
+from app.models import User, Message, Conference
+from app.models.models import SEARCH_LIMIT, SNIPPET_START, SNIPPET_STOP
 
 from .sse import event_emitter
 from .events import MessageReceive
 from .events import MessageEdit
 from .events import MessageDelete
+from .events import ChatCreate
 
 
 @event_emitter(MessageReceive)
@@ -18,12 +22,11 @@ async def store_pm(
     chat_type: int = 1
 ):
     m = Message(text=text.strip())
-    id = await m.bind(sender=from_, receiver=to, chat_type=chat_type)
-    attachments = [
-        Attachment(file_id=attachment, message_id=id, position=i)
-        for i, attachment in enumerate(attachments)
-    ]
-    return m, id, await store(*attachments)
+    attachments = list(attachments)
+    id = await m.bind(
+        sender=from_, receiver=to, chat_type=chat_type, attachments=attachments
+    )
+    return m, id, attachments
 
 
 @event_emitter(MessageEdit)
@@ -35,12 +38,20 @@ async def edit(
     attachments: Optional[Iterable[int]] = None,
     chat_type: int = 1
 ):
-    await User(id=from_).update_pm(to, id, text, attachments, chat_type)
+    message = await User(id=from_).update_pm(
+        to, id, text, attachments, chat_type
+    )
+    if message is None:
+        raise ValueError('message not found')
+    return message
 
 
 @event_emitter(MessageDelete)
 async def delete(from_: int, to: int, id: int, chat_type: int = 1):
-    await User(id=from_).delete_pm(to, id, chat_type)
+    message = await User(id=from_).delete_pm(to, id, chat_type)
+    if message is None:
+        raise ValueError('message not found')
+    return message
 
 
 async def get_pms(
@@ -48,16 +59,18 @@ async def get_pms(
     interlocutor: int,
     offset: int,
     count: int,
-    chat_type
+    chat_type,
+    before: Optional[int] = None,
+    after: Optional[int] = None
 ) -> list:
     u = User(id=requester)
     if chat_type == 1:
         message_rows = await u.get_personal_history(
-            interlocutor, offset, count
+            interlocutor, offset, count, before=before, after=after
         )
     elif chat_type == 2:
         message_rows = await u.get_conversation_history(
-            interlocutor, offset, count
+            interlocutor, offset, count, before=before, after=after
         )
     msgs = [
         {
@@ -79,9 +92,141 @@ async def get_pms(
     return msgs
 
 
+async def get_history(
+    requester: int,
+    interlocutor: int,
+    chat_type: int = 1,
+    offset: int = 0,
+    count: int = 100,
+    cursor: Optional[str] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None
+) -> Tuple[list, Optional[str]]:
+    """
+    Gets a page of chat's history by cursor, message number or offset.
+    Returns messages and a cursor of next page (None if it's the last).
+    """
+    if cursor is not None:
+        direction, message_id = decode_cursor(cursor)
+        before, after = None, None
+        if direction == 'before':
+            before = message_id
+        else:
+            after = message_id
+    if before is not None:
+        before, direction = int(before), 'before'
+    elif after is not None:
+        after, direction = int(after), 'after'
+    else:
+        direction = 'before' if offset < 0 else 'after'
+    messages = await get_pms(
+        requester, interlocutor, offset, count, chat_type,
+        before=before, after=after
+    )
+    return messages, next_cursor(messages, count, direction)
+
+
+def highlight_snippet(snippet: str) -> str:
+    """
+    Makes HTML of found message's snippet which is safe to render: text is
+    escaped and found words are marked by <mark> tags.
+    """
+    return html.escape(snippet)\
+        .replace(SNIPPET_START, "<mark>")\
+        .replace(SNIPPET_STOP, "</mark>")
+
+
+async def search_pms(
+    requester: int,
+    text: str,
+    count: int,
+    cursor: Optional[str] = None
+) -> Tuple[list, Optional[str]]:
+    """
+    Finds messages of requester's chats. Returns a page of found messages
+    and a cursor of next page (None if it's the last).
+    """
+    if not 0 < count <= SEARCH_LIMIT:
+        raise ValueError('count is out of range')
+    after = decode_search_cursor(cursor) if cursor is not None else None
+    rows = await User(id=requester).search_messages(text, count, after)
+    msgs = [
+        {
+            "id": row.seq,
+            "chat": {
+                "id": row.chat,
+                "chat_type": row.chat_type
+            },
+            "sender": row.sender,
+            "snippet": highlight_snippet(row.snippet),
+            "sent": row.time_sent.timestamp(),
+            "rank": row.rank
+        } for row in rows
+    ]
+    cursor = None
+    if len(rows) == count:
+        cursor = encode_search_cursor(rows[-1].rank, rows[-1].id)
+    return msgs, cursor
+
+
+def encode_cursor(direction: str, message_id: int) -> str:
+    """
+    Packs a history page position into opaque cursor string.
+    """
+    raw = "{}:{}".format(direction, message_id).encode()
+    return urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    Unpacks a cursor made by encode_cursor to direction and message id.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode()).decode()
+        direction, message_id = raw.split(':')
+        message_id = int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+    if direction not in ('before', 'after'):
+        raise ValueError('invalid cursor')
+    return direction, message_id
+
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    """
+    Packs a search results page position into opaque cursor string.
+    """
+    raw = "{!r}:{}".format(rank, message_id).encode()
+    return urlsafe_b64encode(raw).decode()
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Unpacks a cursor made by encode_search_cursor to rank and message id.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode()).decode()
+        rank, message_id = raw.split(':')
+        rank, message_id = float(rank), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+    return rank, message_id
+
+
+def next_cursor(messages: list, count: int, direction: str) -> Optional[str]:
+    """
+    Makes a cursor for page which follows given one (None if it's the last).
+    """
+    if not messages or len(messages) < count:
+        return None
+    return encode_cursor(direction, messages[-1]["id"])
+
+
 async def create_conference(username, owner, users, conf_type):
+    users = [int(user) for user in users]
     c = Conference(username=username)
     await c.create(owner, users)
+    await ChatCreate.emit(c.id, username, [int(owner), *users])
     return c.id
 
 
@@ -93,18 +238,22 @@ async def overview_pms(user):
             'chat': {
                 'id': chat.interlocutor,
                 'username': chat.username,
-                'chat_type': chat.type
+                'chat_type': chat.type,
+                'unread': chat.unread
             },
             'message': {
                 'sender': chat.sender if chat.sender else '',
-                'text': chat.Message.text if chat.Message else '',
-                'sent': chat.Message.time_sent.timestamp() if chat.Message else None,  # noqa
-                # TODO: set 'sent' to creation date if message doesn't exists
+                'text': chat.preview,
+                'sent': chat.last_activity.timestamp(),
             }
         } for chat in chat_rows
     ]
     return chats
 
 
+async def read_pms(user: int, interlocutor: int, chat_type: int = 1):
+    await User(id=user).read_chat(interlocutor, chat_type)
+
+
 async def overview(user):
     pass
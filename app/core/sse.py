@@ -1,22 +1,248 @@
 import asyncio
-from typing import List, Dict, Set, Callable
+import heapq
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import List, Dict, Set, Callable, Iterable, Hashable, Optional
+from typing import Deque, Tuple
 
+from app.models import User
+from app.models import metadata
+
+from .brokers import Broker, InMemoryBroker, PostgresBroker
 from .events.event_mixin import EventMixin
 from .events import MessageReceive, MessageEdit, MessageDelete
 from .events import ChatCreate, ChatDelete
 from .events import NewUser, UserOnline, UserOffline, UserDelete
+from .events import UserChanged
 from .events import SSEStart, SSEEnd
 from .events import PollingStart, PollingRequest, PollingEnd
+from .events import Resync
+
 
+logger = logging.getLogger(__name__)
 
 sse_event_types = (
-    MessageReceive, MessageDelete,
+    MessageReceive, MessageEdit, MessageDelete,
     ChatCreate, ChatDelete,
-    NewUser, UserOnline, UserOffline, UserDelete,
+    NewUser, UserOnline, UserOffline, UserDelete, UserChanged,
     SSEStart, SSEEnd,
     PollingStart, PollingRequest, PollingEnd
 )
 
+# Events which are published to all processes by broker: ones which are
+#  routed to listeners and ones which handlers of other processes need
+#  (e.g. cached users are dropped by changes of users)
+broker_event_types = (
+    MessageReceive, MessageEdit, MessageDelete,
+    ChatCreate,
+    UserOnline, UserOffline,
+    UserChanged, UserDelete
+)
+
+# Listener queues settings defaults
+#  queue_size - max number of events waiting for a slow client
+#  policy - what to do with an event for a client which queue is full:
+#   'drop_oldest' - the oldest queued event is dropped
+#   'coalesce' - queued events made obsolete by the new one (e.g. edits of
+#    the same message) are dropped, or the oldest event if there are none
+#   'disconnect' - queued events are dropped and the client is told to
+#    resync, then its stream is closed
+#  replay_size - max number of user's last events kept to be replayed to
+#   reconnected client (see 'Last-Event-ID')
+#  replay_ttl - seconds for which events of user without streams are kept
+#  presence_delay - seconds after which user without streams goes offline,
+#   so reconnecting (or polling) clients don't flap user's presence
+#  batch_window - seconds for which stream waits for more events after one
+#   arrives, all of them are written at once (superseded ones are dropped);
+#   with 0 only already queued events are batched
+LISTENER_DEFAULTS = {
+    "queue_size": 256,
+    "policy": "drop_oldest",
+    "replay_size": 128,
+    "replay_ttl": 300,
+    "presence_delay": 10,
+    "batch_window": 0,
+}
+
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Brokers which deliver events to events APIs (see app.core.brokers):
+#  'memory' - events of process are delivered only to its clients
+#  'postgres' - events are delivered to all processes by DB notifications
+BROKERS = ("memory", "postgres")
+
+
+def message_key(event: EventMixin) -> Optional[Hashable]:
+    """
+    Gets a key of message which event is about (None for other events).
+    """
+    if isinstance(event, MessageReceive):
+        message_id = event.id
+    elif isinstance(event, (MessageEdit, MessageDelete)):
+        message_id = event.message_id
+    else:
+        return None
+    if event.chat_type == 2:
+        chat = int(event.receiver)
+    else:
+        chat = tuple(sorted((int(event.sender), int(event.receiver))))
+    return event.chat_type, chat, message_id
+
+
+def supersedes(event: EventMixin, queued: EventMixin) -> bool:
+    """
+    Checks whether queued event is made obsolete by a new one: a message's
+    edit supersedes its previous edits, deletion supersedes everything.
+    """
+    if isinstance(event, MessageEdit):
+        obsolete = (MessageEdit,)
+    elif isinstance(event, MessageDelete):
+        obsolete = (MessageReceive, MessageEdit)
+    else:
+        return False
+    return isinstance(queued, obsolete) \
+        and message_key(queued) == message_key(event)
+
+
+def coalesce(events: List[EventMixin]) -> List[EventMixin]:
+    """
+    Drops events made obsolete by later events of the same list.
+    """
+    later: Dict[Hashable, List[EventMixin]] = {}
+    kept = []
+    for event in reversed(events):
+        key = message_key(event)
+        if key is not None:
+            superseding = later.setdefault(key, [])
+            if any(supersedes(newer, event) for newer in superseding):
+                continue
+            superseding.append(event)
+        kept.append(event)
+    kept.reverse()
+    return kept
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of user's last events. Knows which events may be missing
+    from it: ones evicted by newer ones or sent before buffer was made.
+    """
+
+    def __init__(self, size: int, last_id: int):
+        self.events: deque = deque(maxlen=size)
+        # Events with this and lower ids may be missing
+        self.floor = last_id
+
+    def append(self, event: EventMixin) -> None:
+        if len(self.events) == self.events.maxlen:
+            self.floor = self.events[0].event_id
+        self.events.append(event)
+
+    def since(self, last_id: int) -> Optional[list]:
+        """
+        Gets events which follow event with given id (None if some of them
+        are missing).
+        """
+        if last_id < self.floor:
+            return None
+        return [event for event in self.events if event.event_id > last_id]
+
+
+class ListenerQueue:
+    """
+    Bounded queue of events for one client. Events are put without waiting
+    by 'offer', which applies overflow policy when queue is full, and are
+    got like from asyncio.Queue ('get', 'get_nowait').
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        maxsize: int,
+        policy: str,
+        batch_window: float = 0
+    ):
+        self.maxsize = maxsize
+        self.events: Deque[EventMixin] = deque()
+        # Set while there are events
+        self.ready = asyncio.Event()
+        self.user_id = user_id
+        self.policy = policy
+        self.batch_window = batch_window
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+
+    def qsize(self) -> int:
+        return len(self.events)
+
+    def empty(self) -> bool:
+        return not self.events
+
+    def full(self) -> bool:
+        return len(self.events) >= self.maxsize
+
+    def get_nowait(self) -> EventMixin:
+        if not self.events:
+            raise asyncio.QueueEmpty
+        event = self.events.popleft()
+        if not self.events:
+            self.ready.clear()
+        return event
+
+    async def get(self) -> EventMixin:
+        # Other getter may take the event first, then it's waited again
+        while not self.events:
+            await self.ready.wait()
+        return self.get_nowait()
+
+    async def batch(self, first: EventMixin) -> List[EventMixin]:
+        """
+        Gets events which arrive within 'batch_window' seconds after the
+        first (got) one, without superseded ones.
+        """
+        if self.batch_window > 0:
+            await asyncio.sleep(self.batch_window)
+        events = [first]
+        while not self.empty():
+            events.append(self.get_nowait())
+        if len(events) == 1:
+            return events
+        kept = coalesce(events)
+        self.coalesced += len(events) - len(kept)
+        return kept
+
+    def offer(self, event: EventMixin) -> int:
+        """
+        Puts an event. Returns a number of dropped events.
+        """
+        if self.closed:
+            return 0
+        dropped = 0
+        if self.full():
+            if self.policy == "disconnect":
+                dropped = self.qsize() + 1
+                self.events.clear()
+                self.closed = True
+                event = Resync("queue overflow")
+            else:
+                if self.policy == "coalesce":
+                    obsolete = [
+                        queued for queued in self.events
+                        if supersedes(event, queued)
+                    ]
+                    for queued in obsolete:
+                        self.events.remove(queued)
+                    dropped = len(obsolete)
+                if not dropped:
+                    self.events.popleft()
+                    dropped = 1
+        self.dropped += dropped
+        self.events.append(event)
+        self.ready.set()
+        return dropped
+
 
 def event_emitter(event: EventMixin, method=False, prefire=False) -> Callable:
 
@@ -35,6 +261,8 @@ def event_emitter(event: EventMixin, method=False, prefire=False) -> Callable:
                 time = message.time_sent
                 kwargs['time_sent'] = time.timestamp()
                 kwargs['id'] = id
+            elif event is MessageEdit:
+                kwargs['time_edit'] = result.time_edit.timestamp()
             await event.emit(*e_args, **kwargs)
             return result
 
@@ -64,55 +292,367 @@ class ServerSentEventsAPI:
     def __init__(self):
         if self.__no_init:
             return
-        self.events_queues = {
-            event_type: asyncio.Queue() for event_type in sse_event_types
-        }
-        self.listener_queues: Dict[int, Set[asyncio.Queue]] = {}
-        self.ensures: List[asyncio.Task] = []
-        self.is_working = True
+        self.listener_queues: Dict[int, Set[ListenerQueue]] = {}
+        # Membership index of listening users: conferences of each user and
+        #  listening members of each conference. Users without streams stay
+        #  in it for 'replay_ttl' seconds (ordered by their deadlines), so
+        #  their events are buffered until they reconnect
+        self.listener_conferences: Dict[int, Set[int]] = {}
+        self.conference_listeners: Dict[int, Set[int]] = {}
+        self.lingering: OrderedDict = OrderedDict()
+        self.replay: Dict[int, ReplayBuffer] = {}
+        # Event ids are microseconds of start plus dispatched events count,
+        #  so they grow across restarts and ids sent before a restart fall
+        #  below floors of all buffers
+        self.last_event_id = int(time.time() * 1000000)
+        self.queue_size = LISTENER_DEFAULTS["queue_size"]
+        self.policy = LISTENER_DEFAULTS["policy"]
+        self.replay_size = LISTENER_DEFAULTS["replay_size"]
+        self.replay_ttl = LISTENER_DEFAULTS["replay_ttl"]
+        # Presence of users: online users are ones with streams or ones
+        #  which lost them less than 'presence_delay' seconds ago (they have
+        #  timers to go offline); it's known by streams of this process only,
+        #  so user with streams in several processes may be announced offline
+        #  by one of them
+        self.online: Set[int] = set()
+        self.offline_timers: Dict[int, asyncio.TimerHandle] = {}
+        self.announcements: Set[asyncio.Future] = set()
+        self.presence_delay = LISTENER_DEFAULTS["presence_delay"]
+        self.batch_window = LISTENER_DEFAULTS["batch_window"]
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnects = 0
+        self.broker_name = "memory"
+        self.broker: Broker = InMemoryBroker(self.dispatch)
         self._init_handlers()
-        self.start()
+
+    def configure(
+        self,
+        queue_size: Optional[int] = None,
+        policy: Optional[str] = None,
+        replay_size: Optional[int] = None,
+        replay_ttl: Optional[float] = None,
+        presence_delay: Optional[float] = None,
+        batch_window: Optional[float] = None,
+        broker: Optional[str] = None
+    ) -> None:
+        """
+        Sets listener queues settings (see LISTENER_DEFAULTS), which are
+        applied to queues made after it, and events broker (see BROKERS),
+        which is used after 'connect'.
+        """
+        if broker is not None:
+            if broker not in BROKERS:
+                raise ValueError("unknown broker: {}".format(broker))
+            self.broker_name = broker
+        if policy is not None:
+            if policy not in OVERFLOW_POLICIES:
+                raise ValueError("unknown overflow policy: {}".format(policy))
+            self.policy = policy
+        if queue_size is not None:
+            if queue_size <= 0:
+                raise ValueError("queue size must be positive")
+            self.queue_size = queue_size
+        if replay_size is not None:
+            if replay_size <= 0:
+                raise ValueError("replay size must be positive")
+            self.replay_size = replay_size
+        if replay_ttl is not None:
+            self.replay_ttl = replay_ttl
+        if presence_delay is not None:
+            if presence_delay < 0:
+                raise ValueError("presence delay must be non-negative")
+            self.presence_delay = presence_delay
+        if batch_window is not None:
+            if batch_window < 0:
+                raise ValueError("batch window must be non-negative")
+            self.batch_window = batch_window
+
+    async def connect(self) -> None:
+        """
+        Starts configured broker (after DB is initialized).
+        """
+        if self.broker_name == "postgres":
+            dsn = metadata.bind.url.set(drivername="postgresql")
+            broker = PostgresBroker(
+                self.dispatch,
+                dsn.render_as_string(hide_password=False),
+                {event_type.__name__: event_type
+                 for event_type in broker_event_types}
+            )
+            await broker.start()
+            self.broker = broker
 
     def _init_handlers(self) -> None:
-        for event_type, queue in self.events_queues.items():
-            event_type.add_handler(queue.put)
-
-    def start(self):
-        self.is_working = True
-        for queue in self.events_queues.values():
-            ensure = asyncio.ensure_future(self.queue_processor(queue))
-            self.ensures.append(ensure)
-
-    async def queue_processor(self, events_queue):
-        EMPTY = set()
-        while self.is_working:
-            event = await events_queue.get()
-            queues = set()
-            if isinstance(event, (MessageReceive, MessageEdit, MessageDelete)):
-                sender = int(event.sender)
-                receiver = int(event.receiver)
-                queues.update(self.listener_queues.get(sender, EMPTY))
-                queues.update(self.listener_queues.get(receiver, EMPTY))
-            elif event is None:
-                break
-            for queue in queues:
-                await queue.put(event)
+        # Events are routed to listeners when they're made, without passing
+        #  through tasks and queues of event types
+        for event_type in broker_event_types:
+            event_type.add_direct_handler(self.publish)
+
+    def publish(self, event: EventMixin) -> None:
+        self.broker.publish(event)
 
-    def get_events_queue(self, user_id) -> asyncio.Queue:
+    def dispatch(self, event: EventMixin) -> None:
+        """
+        Puts an event delivered by broker into queues of its listeners and
+        replay buffers of its users.
+        """
+        EMPTY = ()
+        users = EMPTY
+        if isinstance(event, (MessageReceive, MessageEdit, MessageDelete)):
+            receiver = int(event.receiver)
+            if event.chat_type == 2:
+                users = self.conference_listeners.get(receiver, EMPTY)
+            else:
+                users = (int(event.sender), receiver)
+        elif isinstance(event, ChatCreate):
+            users = [int(member) for member in event.members]
+            self.add_members(event.chat_id, users)
+        elif isinstance(event, (UserOnline, UserOffline)):
+            users = [int(user) for user in event.recipients or ()]
+        if self.lingering:
+            self.prune()
+        queues = set()
+        for user in users:
+            buffer = self.replay.get(user)
+            if buffer is None:
+                continue
+            if event.event_id is None:
+                self.last_event_id += 1
+                event.event_id = self.last_event_id
+            buffer.append(event)
+            queues.update(self.listener_queues.get(user, EMPTY))
+        if queues:
+            # Payload is encoded here once and shared by all streams
+            event.as_sse()
+        for queue in queues:
+            dropped = queue.offer(event)
+            if dropped:
+                self.dropped += dropped
+                self.disconnects += queue.closed
+
+    def add_members(self, conference: int, members: Iterable[int]) -> None:
+        """
+        Adds listening users of given ones to conference's listeners. It's
+        done for members of created conferences (ChatCreate) only: server
+        has no paths which add or remove members of existing conferences, so
+        there are no events to update the index by. Such paths must call it
+        (and drop removed members from 'conference_listeners') or listeners
+        get events of conferences according to their members at connect.
+        """
+        for member in members:
+            conferences = self.listener_conferences.get(member)
+            if conferences is not None:
+                conferences.add(conference)
+                listeners = self.conference_listeners.setdefault(
+                    conference, set()
+                )
+                listeners.add(member)
+
+    async def get_events_queue(
+        self,
+        user_id,
+        last_event_id: Optional[str] = None
+    ) -> ListenerQueue:
+        """
+        Makes a queue of user's events. If id of the last event received by
+        client is given, missed events are put into it first, or Resync
+        event if some of them aren't kept anymore.
+        """
+        self.lingering.pop(user_id, None)
+        self.prune()
+        if user_id not in self.listener_conferences:
+            # Conferences are loaded once by user's first queue (and then
+            #  updated by ChatCreate only, see 'add_members'); user is
+            #  indexed before the query, so conferences created meanwhile
+            #  are added too
+            self.listener_conferences[user_id] = set()
+            try:
+                conferences = await User(id=user_id).get_conferences_ids()
+            except BaseException:
+                if not self.listener_queues.get(user_id):
+                    self.listener_conferences.pop(user_id, None)
+                raise
+            for conference in conferences:
+                self.add_members(conference, (user_id,))
+        buffer = self.replay.get(user_id)
+        if buffer is None:
+            buffer = self.replay[user_id] = ReplayBuffer(
+                self.replay_size, self.last_event_id
+            )
         user_queues: set = self.listener_queues.setdefault(user_id, set())
-        queue = asyncio.Queue()
+        queue = ListenerQueue(
+            user_id, self.queue_size, self.policy, self.batch_window
+        )
+        if not user_queues:
+            self.set_online(user_id)
         user_queues.add(queue)
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                last_event_id = 0
+            # Each process numbers events by itself, so id of other process
+            #  may be unknown here
+            missed = None
+            if last_event_id <= self.last_event_id:
+                missed = buffer.since(last_event_id)
+            if missed is None or len(missed) > queue.maxsize:
+                queue.offer(Resync("events are lost"))
+            else:
+                for event in missed:
+                    queue.offer(event)
         return queue
 
     async def del_events_queue(self, user_id, queue) -> None:
-        user_queues: set = self.listener_queues.setdefault(user_id, set())
+        user_queues: set = self.listener_queues.get(user_id, set())
         user_queues.discard(queue)
+        self.coalesced += queue.coalesced
+        queue.coalesced = 0
+        if not user_queues:
+            self.listener_queues.pop(user_id, None)
+            loop = asyncio.get_event_loop()
+            self.offline_timers[user_id] = loop.call_later(
+                self.presence_delay, self.set_offline, user_id
+            )
+            self.lingering[user_id] = time.monotonic() + self.replay_ttl
+            self.lingering.move_to_end(user_id)
+            self.prune()
         while not queue.empty():
             _ = await queue.get()
 
+    def set_online(self, user_id: int) -> None:
+        """
+        Marks user as online when it gets the first stream. User which
+        reconnects before going offline doesn't change its presence.
+        """
+        timer = self.offline_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        elif user_id not in self.online:
+            self.online.add(user_id)
+            self.announce(UserOnline, user_id)
+
+    def set_offline(self, user_id: int) -> None:
+        del self.offline_timers[user_id]
+        self.online.discard(user_id)
+        self.announce(UserOffline, user_id)
+
+    def announce(self, event_type, user_id: int) -> None:
+        """
+        Tells user's interlocutors about change of its presence.
+        """
+        async def emit():
+            followers = await User(id=user_id).get_interlocutors_ids()
+            # Presence may change again while followers are loaded, then
+            #  the outdated event isn't sent
+            if (user_id in self.online) == (event_type is UserOnline):
+                await event_type.emit(user_id, followers)
+
+        def done(future: asyncio.Future) -> None:
+            self.announcements.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(
+                    "Presence of user %s isn't announced", user_id,
+                    exc_info=future.exception()
+                )
+
+        future = asyncio.ensure_future(emit())
+        self.announcements.add(future)
+        future.add_done_callback(done)
+
+    async def poll(
+        self,
+        user_id: int,
+        cursor: Optional[str] = None,
+        timeout: float = 0
+    ) -> Tuple[List[EventMixin], int]:
+        """
+        Waits up to 'timeout' seconds for user's events which follow the
+        event with given id (cursor) and gets all of them at once. Returns
+        events and a cursor of the next poll.
+
+        Between polls user is lingering, so events are kept in their replay
+        buffer and the next poll gets them by cursor.
+        """
+        queue = await self.get_events_queue(user_id, cursor)
+        # Events sent after this one are put into the queue
+        last_event_id = self.last_event_id
+        events = []
+        try:
+            first = None
+            if not queue.empty():
+                first = queue.get_nowait()
+            elif timeout > 0:
+                try:
+                    first = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if first is not None:
+                events = await queue.batch(first)
+        finally:
+            await self.del_events_queue(user_id, queue)
+        ids = [event.event_id for event in events if event.event_id]
+        return events, max([last_event_id, *ids])
+
+    def prune(self) -> None:
+        """
+        Forgets users which have no streams for longer than 'replay_ttl'.
+        """
+        now = time.monotonic()
+        while self.lingering:
+            user_id, deadline = next(iter(self.lingering.items()))
+            if deadline > now:
+                break
+            del self.lingering[user_id]
+            self.replay.pop(user_id, None)
+            for conference in self.listener_conferences.pop(user_id, ()):
+                listeners = self.conference_listeners.get(conference)
+                if listeners is not None:
+                    listeners.discard(user_id)
+                    if not listeners:
+                        del self.conference_listeners[conference]
+
+    def stats(self, slowest: int = 5) -> dict:
+        """
+        Gets listener queues' settings, dropped events counters and the most
+        lagging listeners.
+        """
+        queues = [
+            queue for user_queues in self.listener_queues.values()
+            for queue in user_queues
+        ]
+        lagging = heapq.nlargest(
+            slowest, queues, key=lambda queue: (queue.qsize(), queue.dropped)
+        )
+        return {
+            "broker": self.broker_name,
+            "queue_size": self.queue_size,
+            "policy": self.policy,
+            "batch_window": self.batch_window,
+            "users": len(self.listener_queues),
+            "online": len(self.online),
+            "lingering": len(self.lingering),
+            "listeners": len(queues),
+            "queued": sum(queue.qsize() for queue in queues),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced + sum(
+                queue.coalesced for queue in queues
+            ),
+            "disconnects": self.disconnects,
+            "slowest": [
+                {
+                    "user": queue.user_id,
+                    "queued": queue.qsize(),
+                    "dropped": queue.dropped
+                } for queue in lagging
+            ],
+        }
+
     async def stop(self):
-        self.is_working = False
-        for queue in self.events_queues.values():
-            await queue.put(None)
-        await asyncio.gather(*self.ensures)
-        self.ensures.clear()
+        for timer in self.offline_timers.values():
+            timer.cancel()
+        self.offline_timers.clear()
+        await asyncio.gather(*self.announcements, return_exceptions=True)
+        await self.broker.stop()
+        self.broker = InMemoryBroker(self.dispatch)
@@ -1,33 +1,115 @@
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from hashlib import sha256
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
 import errors
 from app.models import User as UserModel, Conference
 from app.models import AuthData
 from app.models import new_session
+from app.models.models import SEARCH_LIMIT
+from utils.cache import TTLCache, cached
 
+from .entities import User
+from .events import UserChanged, UserDelete
 
-class User:
-    pass
 
+# Users resolution cache settings
+#  Usernames and ids almost never change, so resolved users are kept for a
+#  few minutes. Users are neither renamed nor deleted by server yet, so
+#  nothing emits UserChanged/UserDelete: users changed in DB directly are
+#  seen after USERS_CACHE_TTL, paths which change them must emit the events
+#  to drop them at once
+USERS_CACHE_SIZE = 4096
+USERS_CACHE_TTL = 300
 
-async def get_by_id(user_id, type) -> Optional[UserModel]:
+users_cache = TTLCache(USERS_CACHE_SIZE, USERS_CACHE_TTL)
+
+
+@cached(users_cache, key=lambda user_id: ("id", user_id))
+async def get_user(user_id: int) -> Optional[User]:
+    user = await UserModel.get(user_id)
+    if user is None:
+        return None
+    return User.from_object(user)
+
+
+async def get_by_id(user_id, type) -> Optional[Union[User, Conference]]:
     if type == 1:
-        user = await UserModel.get(user_id)
+        user = await get_user(user_id)
     elif type == 2:
         user = await Conference.get(user_id)
     return user
 
 
-async def resolve(username) -> Optional[UserModel]:
-    user = await UserModel.resolve(username)
-    return user
+@cached(users_cache, key=lambda username: ("username", username))
+async def resolve(username) -> Optional[User]:
+    row = await UserModel.resolve(username)
+    if row is None:
+        return None
+    return User.from_object(row.User)
+
+
+def invalidate(user_id: int, username: Optional[str] = None) -> None:
+    """
+    Drops cached info of user. Username is needed if user is renamed and
+    wasn't resolved by id.
+    """
+    user = users_cache.invalidate(("id", user_id))
+    if user is not None:
+        users_cache.invalidate(("username", user.username))
+    if username is not None:
+        users_cache.invalidate(("username", username))
+
+
+async def on_user_changed(event):
+    invalidate(event.id, event.username)
+
+
+UserChanged.add_handler(on_user_changed)
+UserDelete.add_handler(on_user_changed)
+
+
+def encode_search_cursor(rank: int, key: str, user_id: int) -> str:
+    """
+    Packs a search results page position into opaque cursor string.
+    """
+    raw = "{}:{}:{}".format(rank, user_id, key).encode()
+    return urlsafe_b64encode(raw).decode()
+
+
+def decode_search_cursor(cursor: str) -> Tuple[int, str, int]:
+    """
+    Unpacks a cursor made by encode_search_cursor to rank, key and user id.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor.encode()).decode()
+        rank, user_id, key = raw.split(':', 2)
+        rank, user_id = int(rank), int(user_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+    return rank, key, user_id
 
 
-async def search(username) -> List[UserModel]:
-    users_list = await UserModel.search(username)
-    users_list = [(row.User.id, row.User.username) for row in users_list]
-    return users_list
+async def search(
+    username: str,
+    count: int = SEARCH_LIMIT,
+    cursor: Optional[str] = None
+) -> Tuple[List[Tuple[int, str]], Optional[str]]:
+    """
+    Finds users by part of username. Returns a page of (id, username) pairs
+    and a cursor of next page (None if it's the last).
+    """
+    if not 0 < count <= SEARCH_LIMIT:
+        raise ValueError('count is out of range')
+    after = decode_search_cursor(cursor) if cursor is not None else None
+    rows = await UserModel.search(username, count, after)
+    users_list = [(row.id, row.username) for row in rows]
+    next_cursor = None
+    if len(rows) == count:
+        last = rows[-1]
+        next_cursor = encode_search_cursor(last.rank, last.key, last.id)
+    return users_list, next_cursor
 
 
 async def login(username: str, hexdigest: str):
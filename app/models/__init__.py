@@ -6,6 +6,7 @@ from .models import User, Relation, AuthData, Token
 from .models import Message, Conference, Role, Permission
 from .models import File, Attachment
 
-from .models import init, drop, metadata
+from .models import init, upgrade, drop, metadata
 from .models import store
-from .base import new_session
+from .base import new_session, request_session
+from .pool import pool_stats
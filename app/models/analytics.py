@@ -2,54 +2,162 @@
 Module with functions for getting analytics about users, messages, etc
 """
 
+from datetime import datetime as dt, timedelta
+from typing import Optional
+
 from app.models.base import with_session
-from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import select, and_, text
 from sqlalchemy.sql.functions import func
 
-from .bindings import users_messages, conferences_messages
-from .models import User, Message, Conference, execute
+from .bindings import users_counters, activity_rollups
+from .models import User, Conference, execute
+
+
+# Periods of activity rollups' buckets
+PERIODS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+# Aggregation settings
+#  Rows are aggregated in order of ids by batches. Rows younger than settle
+#  time are left for next run: transaction which inserted a row with lower id
+#  may be not committed yet. Active users of buckets are kept until buckets
+#  are older than senders TTL
+AGGREGATION_BATCH = 10000
+SETTLE_TIME = timedelta(seconds=10)
+SENDERS_TTL = timedelta(days=2)
+
+# Last id of source's rows which can be aggregated: the one before first not
+#  settled row of batch
+AGGREGATION_BOUND = """
+    SELECT coalesce(min(id) FILTER (WHERE created >= :settled) - 1, max(id))
+    FROM (
+        SELECT id, {created} AS created FROM {source}
+        WHERE id > :after
+        ORDER BY id
+        LIMIT :batch
+    ) AS batch
+"""
+
+AGGREGATE_MESSAGES = """
+    WITH batch AS (
+        SELECT m.time_sent, coalesce(pm.sender, cm.sender) AS sender,
+            CASE WHEN cm.message IS NULL THEN 1 ELSE 2 END AS chat_type,
+            coalesce(cm.conference, 0) AS chat,
+            coalesce(attached.files, 0) AS attachments,
+            coalesce(attached.size, 0) AS attachments_size
+        FROM messages AS m
+        LEFT JOIN personal_messages AS pm ON pm.message = m.id
+        LEFT JOIN conferences_messages AS cm ON cm.message = m.id
+        LEFT JOIN LATERAL (
+            SELECT count(*) AS files, sum(f.size) AS size
+            FROM attachments AS a
+            JOIN files AS f ON f.id = a.file
+            WHERE a.message = m.id
+        ) AS attached ON true
+        WHERE m.id > :after AND m.id <= :until
+            AND (pm.message IS NOT NULL OR cm.message IS NOT NULL)
+    ),
+    expanded AS (
+        SELECT periods.period, scopes.chat_type, scopes.chat,
+            date_trunc(periods.period, batch.time_sent) AS bucket,
+            batch.sender, batch.attachments, batch.attachments_size
+        FROM batch
+        CROSS JOIN (VALUES ('hour'), ('day')) AS periods (period)
+        CROSS JOIN LATERAL (
+            VALUES (0, 0), (batch.chat_type, batch.chat)
+        ) AS scopes (chat_type, chat)
+    ),
+    new_senders AS (
+        INSERT INTO rollups_senders (period, chat_type, chat, bucket, "user")
+        SELECT DISTINCT period, chat_type, chat, bucket, sender
+        FROM expanded
+        ON CONFLICT DO NOTHING
+        RETURNING period, chat_type, chat, bucket
+    ),
+    counted AS (
+        SELECT period, chat_type, chat, bucket, count(*) AS messages,
+            sum(attachments) AS attachments,
+            sum(attachments_size) AS attachments_size, 0 AS active_users
+        FROM expanded
+        GROUP BY period, chat_type, chat, bucket
+        UNION ALL
+        SELECT period, chat_type, chat, bucket, 0, 0, 0, count(*)
+        FROM new_senders
+        GROUP BY period, chat_type, chat, bucket
+    )
+    INSERT INTO activity_rollups (
+        period, chat_type, chat, bucket,
+        messages, attachments, attachments_size, active_users
+    )
+    SELECT period, chat_type, chat, bucket, sum(messages), sum(attachments),
+        sum(attachments_size), sum(active_users)
+    FROM counted
+    GROUP BY period, chat_type, chat, bucket
+    ORDER BY period, chat_type, chat, bucket
+    ON CONFLICT (period, chat_type, chat, bucket) DO UPDATE SET
+        messages = activity_rollups.messages + excluded.messages,
+        attachments = activity_rollups.attachments + excluded.attachments,
+        attachments_size =
+            activity_rollups.attachments_size + excluded.attachments_size,
+        active_users = activity_rollups.active_users + excluded.active_users
+"""
+
+AGGREGATE_UPLOADS = """
+    INSERT INTO activity_rollups (
+        period, chat_type, chat, bucket, uploads, uploads_size
+    )
+    SELECT periods.period, 0, 0, date_trunc(periods.period, f.loaded_at),
+        count(*), coalesce(sum(f.size), 0)
+    FROM files AS f
+    CROSS JOIN (VALUES ('hour'), ('day')) AS periods (period)
+    WHERE f.id > :after AND f.id <= :until
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (period, chat_type, chat, bucket) DO UPDATE SET
+        uploads = activity_rollups.uploads + excluded.uploads,
+        uploads_size = activity_rollups.uploads_size + excluded.uploads_size
+"""
+
+# Aggregated sources: (table, creation time column, aggregation statement)
+AGGREGATED_SOURCES = (
+    ("messages", "time_sent", AGGREGATE_MESSAGES),
+    ("files", "loaded_at", AGGREGATE_UPLOADS),
+)
 
 
 @with_session
 async def users_stats(*, session):
-    pms = users_messages
-    pm = pms.c
-    cms = conferences_messages
-    cm = cms.c
-    sended_pms = select(
-            pm.sender, func.count().label('sended')
-        ).select_from(
-            pms
-        ).group_by(
-            pm.sender
-        ).order_by(
-            pm.sender
-        ).subquery()
-    sended_pm = sended_pms.c
-    receved_pms = select(
-            pm.receiver, func.count().label('received')
-        ).select_from(
-            pms
-        ).group_by(
-            pm.receiver
-        ).order_by(
-            pm.receiver
-        ).subquery()
-    received_pm = receved_pms.c
+    """
+    Gets numbers of personal messages sent and received by each user, who
+    has both sent and received ones, and their averages and medians.
+
+    Numbers are read from maintained counters, so statistics cost a single
+    pass over counters instead of grouping all messages.
+    """
+
+    counter = users_counters.c
+    has_messages = and_(counter.sent > 0, counter.received > 0)
     personal_messages = select(
             User,
-            sended_pms.c.sended,
-            receved_pms.c.received
+            counter.sent.label('sended'),
+            counter.received.label('received')
         )\
         .select_from(User)\
-        .join(sended_pms, User.id == sended_pm.sender)\
-        .join(receved_pms, User.id == received_pm.receiver)
+        .join(users_counters, User.id == counter.user)\
+        .where(has_messages)\
+        .order_by(User.id)
     general_messages = select(
-        func.avg(personal_messages.c.sended).label("sended_avg"),
-        func.median(personal_messages.c.sended).label("sended_med"),
-        func.avg(personal_messages.c.received).label("received_avg"),
-        func.median(personal_messages.c.received).label("received_med"),
-    ).select_from(personal_messages)
+            func.avg(counter.sent).label("sended_avg"),
+            func.percentile_cont(0.5).within_group(counter.sent)
+            .label("sended_med"),
+            func.avg(counter.received).label("received_avg"),
+            func.percentile_cont(0.5).within_group(counter.received)
+            .label("received_med"),
+        )\
+        .select_from(users_counters)\
+        .where(has_messages)
     exact = await execute(personal_messages, session=session)
     generalized = await execute(general_messages, session=session)
     return {
@@ -59,10 +167,153 @@ async def users_stats(*, session):
 
 
 @with_session
-async def messages_stats():
-    Message
+async def aggregate_activity(
+    batch: int = AGGREGATION_BATCH,
+    settle: timedelta = SETTLE_TIME,
+    *,
+    session
+) -> bool:
+    """
+    Adds next batch of messages and uploads to activity rollups. Returns
+    True if there are more rows to aggregate.
+
+    Progress of each source is locked, so concurrent aggregators (e.g. of
+    several server instances) skip sources which are being aggregated.
+    """
+
+    settled = dt.now() - settle
+    more = False
+    locked = 0
+    for source, created, aggregation in AGGREGATED_SOURCES:
+        await session.execute(
+            text("""
+                INSERT INTO rollups_state (source) VALUES (:source)
+                ON CONFLICT DO NOTHING
+            """),
+            {"source": source}
+        )
+        after = await session.scalar(
+            text("""
+                SELECT last_id FROM rollups_state WHERE source = :source
+                FOR UPDATE SKIP LOCKED
+            """),
+            {"source": source}
+        )
+        if after is None:
+            continue
+        locked += 1
+        until = await session.scalar(
+            text(AGGREGATION_BOUND.format(source=source, created=created)),
+            {"after": after, "settled": settled, "batch": batch}
+        )
+        if until is None or until <= after:
+            continue
+        await session.execute(
+            text(aggregation), {"after": after, "until": until}
+        )
+        await session.execute(
+            text("""
+                UPDATE rollups_state SET last_id = :until
+                WHERE source = :source
+            """),
+            {"source": source, "until": until}
+        )
+        more = more or until - after >= batch
+    # Backlog of an old bucket may take several batches, which need its
+    #  senders, so they're pruned only when all sources are aggregated (and
+    #  locked, so no other aggregator is in progress)
+    if not more and locked == len(AGGREGATED_SOURCES):
+        await session.execute(
+            text("DELETE FROM rollups_senders WHERE bucket < :expired"),
+            {"expired": settled - SENDERS_TTL}
+        )
+    await session.commit()
+    return more
+
+
+def buckets_range(period: str, start: dt, end: dt, limit: int) -> None:
+    """
+    Checks that range of rollups' query is valid and has no more than 'limit'
+    buckets.
+    """
+
+    if period not in PERIODS:
+        raise ValueError('unknown period')
+    if end <= start:
+        raise ValueError('empty range')
+    if (end - start) / PERIODS[period] > limit:
+        raise ValueError('too many buckets in range')
+
+
+@with_session
+async def messages_stats(
+    period: str,
+    start: dt,
+    end: dt,
+    chat_type: int = 0,
+    chat: int = 0,
+    *,
+    session
+):
+    """
+    Gets activity rollups' buckets of range (whole server's ones by default,
+    all dialogs' ones for chat_type 1 or conference's ones for chat_type 2).
+    """
+
+    rollup = activity_rollups.c
+    query = select(
+            rollup.bucket,
+            rollup.messages,
+            rollup.attachments,
+            rollup.attachments_size,
+            rollup.uploads,
+            rollup.uploads_size,
+            rollup.active_users
+        )\
+        .where(
+            rollup.period == period,
+            rollup.chat_type == chat_type,
+            rollup.chat == chat,
+            rollup.bucket >= start,
+            rollup.bucket < end
+        )\
+        .order_by(rollup.bucket)
+    return await execute(query, session=session)
 
 
 @with_session
-async def conferences_stats():
-    Conference
+async def conferences_stats(
+    period: str,
+    start: dt,
+    end: dt,
+    limit: Optional[int] = None,
+    *,
+    session
+):
+    """
+    Gets conferences' totals of messages and attachments over range of
+    rollups' buckets, most active conferences go first.
+    """
+
+    rollup = activity_rollups.c
+    messages = func.sum(rollup.messages).label("messages")
+    query = select(
+            Conference.id,
+            Conference.username,
+            Conference.title,
+            messages,
+            func.sum(rollup.attachments).label("attachments"),
+            func.sum(rollup.attachments_size).label("attachments_size")
+        )\
+        .select_from(activity_rollups)\
+        .join(Conference, Conference.id == rollup.chat)\
+        .where(
+            rollup.period == period,
+            rollup.chat_type == 2,
+            rollup.bucket >= start,
+            rollup.bucket < end
+        )\
+        .group_by(Conference.id)\
+        .order_by(messages.desc(), Conference.id)\
+        .limit(limit)
+    return await execute(query, session=session)
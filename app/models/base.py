@@ -2,14 +2,17 @@
 Module for model's bases - useful functions, constants and Model base class.
 """
 
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from functools import wraps
+from typing import Optional
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import MetaData
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from sqlalchemy.sql.expression import select, text
+from sqlalchemy.sql.expression import select
 
 
 metadata = MetaData()
@@ -20,21 +23,74 @@ RESTRICT = "RESTRICT"
 SET_DEFAULT = "SET DEFAULT"
 SET_NULL = "SET NULL"
 
+# Session opened by 'request_session' for current request (or other scope)
+current_session: ContextVar[Optional[AsyncSession]] = ContextVar(
+    "current_session", default=None
+)
 
-def new_session(metadata: MetaData = metadata, **kwargs) -> AsyncSession:
+
+def new_session(
+    metadata: MetaData = metadata,
+    *,
+    read_only: bool = False,
+    **kwargs
+) -> AsyncSession:
+    """
+    Creates a new session for DB. Read-only session runs read-only
+    transactions ('BEGIN READ ONLY') and isn't committed by 'execute'.
+    """
+    bind = metadata._bind
+    if read_only:
+        bind = read_only_bind(metadata)
+    session = AsyncSession(bind, expire_on_commit=False, **kwargs)
+    session.info["read_only"] = read_only
+    return session
+
+
+def read_only_bind(metadata: MetaData = metadata):
     """
-    Creates a new session for DB.
+    Gets an engine which begins read-only transactions on it's connections.
     """
-    return AsyncSession(metadata._bind, expire_on_commit=False, **kwargs)
+    bind, read_only = metadata.info.get("read_only_bind", (None, None))
+    if bind is not metadata._bind:
+        bind = metadata._bind
+        read_only = bind.execution_options(postgresql_readonly=True)
+        metadata.info["read_only_bind"] = bind, read_only
+    return read_only
+
+
+@asynccontextmanager
+async def request_session(read_only: bool = False):
+    """
+    Opens a session which is used by all functions decorated with
+    'with_session' inside the block instead of their own temporary sessions,
+    so they share one connection and transaction. Session is committed on
+    exit (unless it's read-only) and rolled back on error.
+    """
+    async with new_session(read_only=read_only) as session:
+        token = current_session.set(session)
+        try:
+            yield session
+            if not read_only:
+                await session.commit()
+        finally:
+            # Tasks spawned inside the block have a copy of context
+            session.info["finished"] = True
+            current_session.reset(token)
 
 
 def with_session(async_func):
     """
     Decorator that passes AsyncSession instance to 'session' keyword argument
-    if function called without it.
+    if function called without it. Session of 'request_session' block is
+    passed if there is one, otherwise a temporary session is created.
     """
     @wraps(async_func)
     async def wrapped(*args, **kwargs):
+        if "session" not in kwargs:
+            session = current_session.get()
+            if session is not None and not session.info.get("finished"):
+                kwargs["session"] = session
         if "session" in kwargs:
             result = await async_func(*args, **kwargs)
         else:
@@ -48,38 +104,6 @@ async def with_temp_session(async_func, *args, **kwargs):
         return await async_func(*args, session=session, **kwargs)
 
 
-async def create_median_function(conn):
-    await conn.execute(text("""
-        CREATE OR REPLACE FUNCTION _final_median(anyarray) RETURNS float8 AS $$
-            WITH
-                q AS (
-                    SELECT val
-                    FROM unnest($1) val
-                    WHERE VAL IS NOT NULL
-                    ORDER BY 1
-                ),
-                cnt AS (
-                    SELECT COUNT(*) as c FROM q
-                )
-            SELECT
-                AVG(val)::float8
-            FROM (
-                SELECT val FROM q
-                LIMIT  2 - MOD((SELECT c FROM cnt), 2)
-                OFFSET GREATEST(CEIL((SELECT c FROM cnt) / 2.0) - 1,0)  
-            ) q2;
-            $$ LANGUAGE sql IMMUTABLE;
-    """))
-    await conn.execute(text("""
-        CREATE OR REPLACE AGGREGATE median(anyelement) (
-            SFUNC=array_append,
-            STYPE=anyarray,
-            FINALFUNC=_final_median,
-            INITCOND='{}'
-        );
-    """))
-
-
 class Model(DeclarativeBase):
     """
     Base class for DB models.
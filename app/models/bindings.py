@@ -2,11 +2,14 @@
 Module for binding table's models.
 """
 
-from sqlalchemy import Table, Column, ForeignKey
-from sqlalchemy import Integer, Boolean
+from datetime import datetime as dt
+
+from sqlalchemy import Table, Column, ForeignKey, Index
+from sqlalchemy import Integer, BigInteger, Boolean, Text, DateTime
+from sqlalchemy.sql.functions import func
 
 from .base import Model
-from .base import CASCADE, RESTRICT, SET_DEFAULT
+from .base import CASCADE, RESTRICT, SET_DEFAULT, SET_NULL
 
 
 # User-Conference binding model
@@ -40,7 +43,20 @@ conferences_messages = Table(
            primary_key=True),
     Column("conference", Integer,
            ForeignKey("conferences.id", onupdate=RESTRICT, ondelete=CASCADE),
-           primary_key=True)
+           primary_key=True),
+    Column("seq", Integer, nullable=False)
+)
+Index(
+    "conferences_messages_seq",
+    conferences_messages.c.conference,
+    conferences_messages.c.seq,
+    unique=True
+)
+Index(
+    "conferences_messages_conference",
+    conferences_messages.c.conference,
+    conferences_messages.c.message,
+    postgresql_include=["sender", "seq"]
 )
 
 relations_messages = Table(
@@ -63,7 +79,142 @@ users_messages = Table(
            primary_key=True),
     Column("receiver", Integer,
            ForeignKey("users.id", onupdate=RESTRICT),
-           primary_key=True)
+           primary_key=True),
+    Column("seq", Integer, nullable=False)
+)
+Index(
+    "personal_messages_seq",
+    func.least(users_messages.c.sender, users_messages.c.receiver),
+    func.greatest(users_messages.c.sender, users_messages.c.receiver),
+    users_messages.c.seq,
+    unique=True
+)
+Index(
+    "personal_messages_dialog",
+    func.least(users_messages.c.sender, users_messages.c.receiver),
+    func.greatest(users_messages.c.sender, users_messages.c.receiver),
+    users_messages.c.message,
+    postgresql_include=["sender", "seq"]
+)
+Index(
+    "personal_messages_sender",
+    users_messages.c.sender,
+    users_messages.c.message
+)
+Index(
+    "personal_messages_receiver",
+    users_messages.c.receiver,
+    users_messages.c.message
+)
+
+# Dialog's message counters
+#  This table contains a last allocated message number for each dialog. Users
+#  pair is stored in canonical order (first_user < second_user)
+dialogs_sequences = Table(
+    "dialogs_sequences", Model.metadata,
+    Column("first_user", Integer,
+           ForeignKey("users.id", onupdate=RESTRICT, ondelete=CASCADE),
+           primary_key=True),
+    Column("second_user", Integer,
+           ForeignKey("users.id", onupdate=RESTRICT, ondelete=CASCADE),
+           primary_key=True),
+    Column("last_seq", Integer, nullable=False, server_default="0")
+)
+
+# Conversations summaries
+#  This table contains a row for each (user, chat) pair with chat's last
+#  message and count of messages which user hasn't read. Rows are maintained
+#  together with messages, so user's conversations overview is read by single
+#  index scan. 'chat' is an interlocutor's id for dialogs (chat_type 1) or
+#  conference's id (chat_type 2)
+conversation_summaries = Table(
+    "conversation_summaries", Model.metadata,
+    Column("user", Integer,
+           ForeignKey("users.id", onupdate=RESTRICT, ondelete=CASCADE),
+           primary_key=True),
+    Column("chat_type", Integer, primary_key=True),
+    Column("chat", Integer, primary_key=True),
+    Column("last_message", Integer,
+           ForeignKey("messages.id", onupdate=RESTRICT, ondelete=SET_NULL)),
+    Column("last_seq", Integer),
+    Column("sender", Integer,
+           ForeignKey("users.id", onupdate=RESTRICT, ondelete=SET_NULL)),
+    Column("preview", Text, nullable=False, server_default=""),
+    Column("last_activity", DateTime, nullable=False, default=dt.now),
+    Column("read_seq", Integer, nullable=False, server_default="0"),
+    Column("unread", Integer, nullable=False, server_default="0")
+)
+Index(
+    "conversation_summaries_activity",
+    conversation_summaries.c.user,
+    conversation_summaries.c.last_activity.desc()
+)
+Index(
+    "conversation_summaries_chat",
+    conversation_summaries.c.chat_type,
+    conversation_summaries.c.chat
+)
+
+# Users' personal messages counters
+#  This table contains numbers of personal messages sent and received by each
+#  user. Rows are maintained by triggers on personal_messages (see migration
+#  6), so statistics don't count messages on every request
+users_counters = Table(
+    "users_counters", Model.metadata,
+    Column("user", Integer,
+           ForeignKey("users.id", onupdate=RESTRICT, ondelete=CASCADE),
+           primary_key=True),
+    Column("sent", Integer, nullable=False, server_default="0"),
+    Column("received", Integer, nullable=False, server_default="0")
+)
+
+# Activity rollups
+#  This table contains numbers of messages, attachments and uploads for each
+#  hour and day ('period'). Rows with chat_type 0 are totals of whole server,
+#  chat_type 1 are totals of all dialogs and chat_type 2 are conferences'
+#  ones. Rows are incremented by background aggregator (see
+#  app.models.analytics.aggregate_activity)
+activity_rollups = Table(
+    "activity_rollups", Model.metadata,
+    Column("period", Text, primary_key=True),
+    Column("chat_type", Integer, primary_key=True),
+    Column("chat", Integer, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("messages", Integer, nullable=False, server_default="0"),
+    Column("attachments", Integer, nullable=False, server_default="0"),
+    Column("attachments_size", BigInteger, nullable=False,
+           server_default="0"),
+    Column("uploads", Integer, nullable=False, server_default="0"),
+    Column("uploads_size", BigInteger, nullable=False, server_default="0"),
+    Column("active_users", Integer, nullable=False, server_default="0")
+)
+# Rankings of conferences read buckets of a range across all chats
+Index(
+    "activity_rollups_buckets",
+    activity_rollups.c.period,
+    activity_rollups.c.chat_type,
+    activity_rollups.c.bucket
+)
+
+# Active users of rollups buckets
+#  This table contains users who sent messages in each bucket of
+#  activity_rollups, so a user is counted as active only once. Rows of
+#  closed buckets are removed by aggregator
+rollups_senders = Table(
+    "rollups_senders", Model.metadata,
+    Column("period", Text, primary_key=True),
+    Column("chat_type", Integer, primary_key=True),
+    Column("chat", Integer, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("user", Integer, primary_key=True)
+)
+
+# Aggregation progress
+#  This table contains the last aggregated row's id of each source table
+rollups_state = Table(
+    "rollups_state", Model.metadata,
+    Column("source", Text, primary_key=True),
+    Column("last_id", Integer, nullable=False, server_default="0")
 )
 
 # Roles-Permissions binding model
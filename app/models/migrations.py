@@ -0,0 +1,346 @@
+"""
+Module with versioned schema migrations.
+
+Each migration is a list of SQL statements which brings a schema of previous
+version to the next one. Statements must be idempotent: a fresh schema made by
+'metadata.create_all' already contains all changes.
+"""
+
+import logging
+from datetime import datetime as dt
+from typing import NamedTuple, Sequence
+
+from sqlalchemy import Table, Column
+from sqlalchemy import Integer, Text, DateTime
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.sql.expression import select, text
+from sqlalchemy.sql.functions import func
+
+from .base import metadata
+
+
+logger = logging.getLogger(__name__)
+
+
+# Schema versions model
+#  This table contains a history of applied migrations
+schema_versions = Table(
+    "schema_versions", metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", Text, nullable=False),
+    Column("applied_at", DateTime, nullable=False, default=dt.now)
+)
+
+
+class Migration(NamedTuple):
+
+    version: int
+    description: str
+    statements: Sequence[str]
+
+
+MIGRATIONS = (
+    Migration(1, "per-conversation message sequence numbers", (
+        """
+        ALTER TABLE personal_messages ADD COLUMN IF NOT EXISTS seq integer
+        """,
+        """
+        ALTER TABLE conferences_messages ADD COLUMN IF NOT EXISTS seq integer
+        """,
+        """
+        ALTER TABLE conferences
+            ADD COLUMN IF NOT EXISTS last_seq integer NOT NULL DEFAULT 0
+        """,
+        """
+        UPDATE personal_messages AS pm SET seq = numbered.seq
+        FROM (
+            SELECT message, row_number() OVER (
+                PARTITION BY least(sender, receiver), greatest(sender, receiver)
+                ORDER BY message
+            ) AS seq
+            FROM personal_messages
+        ) AS numbered
+        WHERE pm.message = numbered.message AND pm.seq IS NULL
+        """,
+        """
+        UPDATE conferences_messages AS cm SET seq = numbered.seq
+        FROM (
+            SELECT message, row_number() OVER (
+                PARTITION BY conference ORDER BY message
+            ) AS seq
+            FROM conferences_messages
+        ) AS numbered
+        WHERE cm.message = numbered.message AND cm.seq IS NULL
+        """,
+        """
+        ALTER TABLE personal_messages ALTER COLUMN seq SET NOT NULL
+        """,
+        """
+        ALTER TABLE conferences_messages ALTER COLUMN seq SET NOT NULL
+        """,
+        """
+        INSERT INTO dialogs_sequences (first_user, second_user, last_seq)
+        SELECT least(sender, receiver), greatest(sender, receiver), max(seq)
+        FROM personal_messages
+        GROUP BY least(sender, receiver), greatest(sender, receiver)
+        ON CONFLICT (first_user, second_user) DO UPDATE
+            SET last_seq = greatest(
+                dialogs_sequences.last_seq, excluded.last_seq
+            )
+        """,
+        """
+        UPDATE conferences SET last_seq = counters.last_seq
+        FROM (
+            SELECT conference, max(seq) AS last_seq
+            FROM conferences_messages
+            GROUP BY conference
+        ) AS counters
+        WHERE conferences.id = counters.conference
+            AND conferences.last_seq < counters.last_seq
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS personal_messages_seq
+            ON personal_messages (
+                least(sender, receiver), greatest(sender, receiver), seq
+            )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS conferences_messages_seq
+            ON conferences_messages (conference, seq)
+        """,
+    )),
+    Migration(2, "message binding tables indexes", (
+        """
+        CREATE INDEX IF NOT EXISTS personal_messages_dialog
+            ON personal_messages (
+                least(sender, receiver), greatest(sender, receiver), message
+            )
+            INCLUDE (sender, seq)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS personal_messages_sender
+            ON personal_messages (sender, message)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS personal_messages_receiver
+            ON personal_messages (receiver, message)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS conferences_messages_conference
+            ON conferences_messages (conference, message)
+            INCLUDE (sender, seq)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS messages_not_deleted
+            ON messages (id) WHERE NOT deleted
+        """,
+        """
+        ANALYZE personal_messages, conferences_messages, messages
+        """,
+    )),
+    Migration(3, "conversations summaries", (
+        """
+        INSERT INTO conversation_summaries (
+            "user", chat_type, chat, last_message, last_seq, sender,
+            preview, last_activity, read_seq, unread
+        )
+        SELECT DISTINCT ON (members.member, members.chat)
+            members.member, 1, members.chat, pm.message, pm.seq, pm.sender,
+            left(m.text, 200), m.time_sent, pm.seq, 0
+        FROM personal_messages AS pm
+        JOIN messages AS m ON m.id = pm.message AND NOT m.deleted
+        CROSS JOIN LATERAL (
+            VALUES (pm.sender, pm.receiver), (pm.receiver, pm.sender)
+        ) AS members (member, chat)
+        ORDER BY members.member, members.chat, pm.seq DESC
+        ON CONFLICT DO NOTHING
+        """,
+        """
+        INSERT INTO conversation_summaries (
+            "user", chat_type, chat, last_message, last_seq, sender,
+            preview, last_activity, read_seq, unread
+        )
+        SELECT cu."user", 2, cu.conference, last.message, last.seq,
+            last.sender, coalesce(left(last.text, 200), ''),
+            coalesce(last.time_sent, now()), coalesce(last.seq, 0), 0
+        FROM conferences_users AS cu
+        LEFT JOIN LATERAL (
+            SELECT cm.message, cm.seq, cm.sender, m.text, m.time_sent
+            FROM conferences_messages AS cm
+            JOIN messages AS m ON m.id = cm.message AND NOT m.deleted
+            WHERE cm.conference = cu.conference
+            ORDER BY cm.message DESC
+            LIMIT 1
+        ) AS last ON true
+        ON CONFLICT DO NOTHING
+        """,
+    )),
+    Migration(4, "users search indexes", (
+        """
+        CREATE INDEX IF NOT EXISTS users_username_search
+            ON users ((lower(username) COLLATE "C"))
+        """,
+        # Trigram index speeds up substring search, but pg_trgm is a contrib
+        #  extension and may be not installed, then substrings are searched
+        #  by scanning the index above
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT FROM pg_available_extensions WHERE name = 'pg_trgm'
+            ) THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS users_username_trgm
+                    ON users USING gin (lower(username) gin_trgm_ops);
+            END IF;
+        END
+        $$
+        """,
+        """
+        ANALYZE users
+        """,
+    )),
+    Migration(5, "messages full-text search", (
+        """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, text)) STORED
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS messages_search
+            ON messages USING gin (search_vector) WHERE NOT deleted
+        """,
+    )),
+    Migration(6, "users messages counters", (
+        # Counters are updated once per statement from its transition table,
+        #  users are locked in order of ids to not deadlock with each other
+        """
+        CREATE OR REPLACE FUNCTION count_personal_messages() RETURNS trigger
+        AS $$
+        DECLARE
+            delta integer := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            INSERT INTO users_counters ("user", sent, received)
+            SELECT counted."user", sum(counted.sent) * delta,
+                sum(counted.received) * delta
+            FROM (
+                SELECT sender AS "user", 1 AS sent, 0 AS received
+                FROM changed
+                UNION ALL
+                SELECT receiver, 0, 1 FROM changed
+            ) AS counted
+            GROUP BY counted."user"
+            ORDER BY counted."user"
+            ON CONFLICT ("user") DO UPDATE SET
+                sent = users_counters.sent + excluded.sent,
+                received = users_counters.received + excluded.received;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS personal_messages_count_insert
+            ON personal_messages
+        """,
+        """
+        CREATE TRIGGER personal_messages_count_insert
+            AFTER INSERT ON personal_messages
+            REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION count_personal_messages()
+        """,
+        """
+        DROP TRIGGER IF EXISTS personal_messages_count_delete
+            ON personal_messages
+        """,
+        """
+        CREATE TRIGGER personal_messages_count_delete
+            AFTER DELETE ON personal_messages
+            REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION count_personal_messages()
+        """,
+        """
+        INSERT INTO users_counters ("user", sent, received)
+        SELECT counted."user", sum(counted.sent), sum(counted.received)
+        FROM (
+            SELECT sender AS "user", count(*) AS sent, 0 AS received
+            FROM personal_messages GROUP BY sender
+            UNION ALL
+            SELECT receiver, 0, count(*)
+            FROM personal_messages GROUP BY receiver
+        ) AS counted
+        GROUP BY counted."user"
+        ON CONFLICT ("user") DO UPDATE SET
+            sent = excluded.sent,
+            received = excluded.received
+        """,
+        # Median aggregate isn't used by statistics anymore
+        """
+        DROP AGGREGATE IF EXISTS median(anyelement)
+        """,
+        """
+        DROP FUNCTION IF EXISTS _final_median(anyarray)
+        """,
+    )),
+    # Rollups tables are created by 'metadata.create_all' before migrations,
+    #  they're filled from existing messages by aggregator
+    Migration(7, "activity rollups", ()),
+    Migration(8, "activity rollups buckets index", (
+        """
+        CREATE INDEX IF NOT EXISTS activity_rollups_buckets
+            ON activity_rollups (period, chat_type, bucket)
+        """,
+    )),
+)
+
+LAST_VERSION = MIGRATIONS[-1].version
+
+# Key of advisory lock which is held while schema is upgraded
+MIGRATIONS_LOCK = 0x6d6967
+
+
+async def get_version(conn: AsyncConnection) -> int:
+    """
+    Gets a version of DB schema (0 for unversioned schema).
+    """
+
+    rows = await conn.execute(select(func.max(schema_versions.c.version)))
+    return rows.scalar() or 0
+
+
+async def schema_version(engine: AsyncEngine) -> int:
+    """
+    Gets a version of DB schema by single query (0 for empty or unversioned
+    DB).
+    """
+
+    async with engine.connect() as conn:
+        try:
+            return await get_version(conn)
+        except ProgrammingError:  # schema_versions table doesn't exist
+            return 0
+
+
+async def migrate(conn: AsyncConnection) -> int:
+    """
+    Applies all pending migrations. Returns a resulting schema version.
+    """
+
+    await conn.run_sync(schema_versions.create, checkfirst=True)
+    version = await get_version(conn)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(
+            "Applying migration %s (%s)",
+            migration.version, migration.description
+        )
+        for statement in migration.statements:
+            await conn.execute(text(statement))
+        await conn.execute(
+            schema_versions.insert().values(
+                version=migration.version,
+                description=migration.description
+            )
+        )
+        version = migration.version
+    return version
@@ -1,49 +1,141 @@
 from __future__ import annotations
 
-import asyncio
 import secrets
 import logging
 from datetime import datetime as dt
 from typing import Tuple, Iterable
-from typing import Optional, Union
+from typing import List, Optional, Union
 
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from sqlalchemy import MetaData
 
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index, Computed
 from sqlalchemy import Boolean, Integer, Text, DateTime, LargeBinary
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql.elements import not_
 
 from sqlalchemy.sql.expression import (
-    select, update, union, func, case, literal
+    select, update, func, case, literal, literal_column, union_all
 )
-from sqlalchemy import or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import or_, and_, tuple_
 
-from .base import Model, metadata, with_session, create_median_function
+from .base import Model, metadata, with_session
 from .base import CASCADE, RESTRICT
 from .bindings import conferences_users, conferences_messages, users_messages
+from .bindings import dialogs_sequences, conversation_summaries
 from .bindings import roles_permissions
+from .migrations import migrate, schema_version, LAST_VERSION, MIGRATIONS_LOCK
+from .pool import engine_options
 from .types import sha512
 
 
 logger = logging.getLogger(__name__)
 
+# Length of message's text stored in conversations summaries
+PREVIEW_LENGTH = 200
 
-async def init(db: str, **options) -> AsyncEngine:
+# Max number of users found by one search request
+SEARCH_LIMIT = 50
+
+# Text search configuration of messages
+#  'simple' one only lowercases words, so it suits any language
+TEXT_SEARCH_CONFIG = "simple"
+SEARCH_CONFIG = literal_column("'{}'::regconfig".format(TEXT_SEARCH_CONFIG))
+
+# Options of found messages' snippets (see ts_headline)
+#  Found words are put between control characters instead of HTML tags, as
+#  messages' text isn't escaped (these characters are removed from it)
+SNIPPET_START = "\x02"
+SNIPPET_STOP = "\x03"
+SNIPPET_OPTIONS = "StartSel={}, StopSel={}, MaxWords=30, MinWords=10".format(
+    SNIPPET_START, SNIPPET_STOP
+)
+
+
+async def init(
+    db: str,
+    pool: Optional[dict] = None,
+    **options
+) -> AsyncEngine:
     """
-    Initialize connection to DB, creating tables
+    Initialize connection to DB. Schema is upgraded only if its version is
+    older than the last one, so startup with current schema costs one query.
+
+    Connection pool is configured by 'pool' settings (see POOL_DEFAULTS),
+    other options are passed to engine as is.
     """
 
+    options = dict(engine_options(pool or {}), **options)
     engine = create_async_engine(db, **options)
     metadata.bind = engine
+    version = await schema_version(engine)
+    if version < LAST_VERSION:
+        await upgrade(engine)
+    elif version > LAST_VERSION:
+        logger.warning(
+            "DB schema version %s is newer than application's one (%s)",
+            version, LAST_VERSION
+        )
+    return engine
+
+
+async def upgrade(engine: AsyncEngine) -> int:
+    """
+    Creates missing tables and applies pending migrations. Returns a resulting
+    schema version.
+
+    Upgrades are serialized by advisory lock, so instances started together
+    don't apply the same migrations twice.
+    """
+
     async with engine.begin() as conn:
+        await conn.execute(select(func.pg_advisory_xact_lock(MIGRATIONS_LOCK)))
         await conn.run_sync(metadata.create_all)
-        await create_median_function(conn)
-        await conn.commit()
-    return engine
+        version = await migrate(conn)
+    return version
+
+
+def chat_binding(chat_type: int, user: int, other: int):
+    """
+    Gets a binding table of chat and a filter which selects chat's messages.
+    """
+
+    if chat_type == 1:
+        bindings = users_messages
+        first, second = sorted((int(user), int(other)))
+        binding_filter = and_(
+            func.least(bindings.c.sender, bindings.c.receiver) == first,
+            func.greatest(bindings.c.sender, bindings.c.receiver) == second,
+        )
+    elif chat_type == 2:
+        bindings = conferences_messages
+        binding_filter = (bindings.c.conference == other)
+    else:
+        raise ValueError("unknown chat type: {}".format(chat_type))
+    return bindings, binding_filter
+
+
+def chat_summaries(chat_type: int, user: int, other: int):
+    """
+    Gets a filter which selects summaries of chat for all it's members.
+    """
+
+    summary = conversation_summaries.c
+    if chat_type == 1:
+        return and_(
+            summary.chat_type == 1,
+            or_(
+                and_(summary.user == user, summary.chat == other),
+                and_(summary.user == other, summary.chat == user),
+            )
+        )
+    elif chat_type == 2:
+        return and_(summary.chat_type == 2, summary.chat == other)
+    raise ValueError("unknown chat type: {}".format(chat_type))
 
 
 async def drop(metadata: MetaData) -> None:
@@ -84,6 +176,25 @@ class Message(Model):
         nullable=True
     )
     deleted = Column(Boolean, nullable=False, default=False)
+    # Generated by DB, so it's always consistent with text (even on edit);
+    #  deferred to not load it with messages
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed(
+            "to_tsvector('{}'::regconfig, text)".format(TEXT_SEARCH_CONFIG),
+            persisted=True
+        )
+    ))
+
+    __table_args__ = (
+        Index("messages_not_deleted", id, postgresql_where=not_(deleted)),
+        Index(
+            "messages_search",
+            "search_vector",
+            postgresql_using="gin",
+            postgresql_where=not_(deleted)
+        ),
+    )
 
     attachments = relationship(
         "Attachment",
@@ -98,52 +209,140 @@ class Message(Model):
         receiver: int,
         *,
         session: AsyncSession,
-        chat_type: int = 1
-    ) -> None:
+        chat_type: int = 1,
+        attachments: Iterable[int] = ()
+    ) -> int:
         """
-        Binds a message to it's sender and receiver.
+        Binds a message to it's sender and receiver and attaches given files
+        to it. Returns a message number in chat.
+
+        Message, it's binding with allocated number, attachments and chat's
+        summaries are stored by single transaction with one commit.
         """
 
         session.add(self)
         await session.flush()
+        # Increment is rendered inline: bound parameters of a hoisted CTE are
+        #  misordered by SQLAlchemy for positional paramstyles (asyncpg)
+        one = literal_column("1")
         params = {}
         if chat_type == 1:
             binding = users_messages
             params.update(sender=sender, receiver=receiver)
-            query_filter = or_(
-                and_(binding.c.sender == sender, binding.c.receiver == receiver),  # noqa
-                and_(binding.c.sender == receiver, binding.c.receiver == sender),  # noqa
-            )
+            first, second = sorted((int(sender), int(receiver)))
+            counter = dialogs_sequences.c
+            seq = insert(dialogs_sequences)\
+                .values(first_user=first, second_user=second, last_seq=one)\
+                .on_conflict_do_update(
+                    index_elements=[counter.first_user, counter.second_user],
+                    set_={"last_seq": counter.last_seq + one}
+                )\
+                .returning(counter.last_seq)
         elif chat_type == 2:
             binding = conferences_messages
             params.update(sender=sender, conference=receiver)
-            query_filter = (binding.c.conference == receiver)
-        await execute(
-            binding.insert().values(message=self.id, **params),
-            session=session,
-            fetch=False, commit=False
-        )
-        message_number = func.row_number().over(order_by=binding.c.message)
-        messages = select(
-                message_number.label('external_id'),
-                Message
-            )\
-            .select_from(binding)\
-            .join(Message)\
-            .filter(
-                query_filter
+            counter = Conference.__table__.c
+            seq = update(Conference.__table__)\
+                .where(counter.id == receiver)\
+                .values(last_seq=counter.last_seq + one)\
+                .returning(counter.last_seq)
+        else:
+            raise ValueError("unknown chat type: {}".format(chat_type))
+        # Number allocation and binding insertion are done by single statement
+        #  and counter row stays locked until commit, so concurrent senders
+        #  can't get the same number
+        seq = seq.cte("seq")
+        query = binding.insert()\
+            .values(
+                message=self.id,
+                seq=select(seq.c.last_seq).scalar_subquery(),
+                **params
             )\
-            .order_by(Message.id)\
-            .subquery()
-        external_id_row = await execute(
-            select(messages.c.external_id).where(messages.c.id == self.id),
-            session=session,
-            commit=False
+            .returning(binding.c.seq)
+        rows = await execute(query, session=session, commit=False)
+        external_id = rows[0].seq
+        await self._summarize(
+            chat_type, sender, receiver, external_id, session=session
         )
-        external_id = external_id_row[0].external_id
+        attachments = [
+            {"file": file, "message": self.id, "position": position}
+            for position, file in enumerate(attachments)
+        ]
+        if attachments:
+            await execute(
+                Attachment.__table__.insert().values(attachments),
+                session=session, fetch=False, commit=False
+            )
         await session.commit()
         return external_id
 
+    async def _summarize(
+        self,
+        chat_type: int,
+        sender: int,
+        receiver: int,
+        seq: int,
+        *,
+        session: AsyncSession
+    ) -> None:
+        """
+        Makes a message the last one in summaries of all chat's members.
+        """
+
+        summary = conversation_summaries.c
+        message = {
+            "last_message": self.id,
+            "last_seq": seq,
+            "sender": sender,
+            "preview": self.text[:PREVIEW_LENGTH],
+            "last_activity": self.time_sent,
+        }
+        if chat_type == 1:
+            members = {(sender, receiver), (receiver, sender)}
+            query = insert(conversation_summaries).values([
+                dict(
+                    message,
+                    user=user,
+                    chat_type=chat_type,
+                    chat=chat,
+                    read_seq=seq if user == sender else 0,
+                    unread=0 if user == sender else 1
+                ) for user, chat in members
+            ])
+        else:
+            member = conferences_users.c.user
+            is_sender = member == sender
+            members = select(
+                    member,
+                    literal(chat_type),
+                    literal(receiver),
+                    *(literal(value) for value in message.values()),
+                    case((is_sender, seq), else_=0),
+                    case((is_sender, 0), else_=1),
+                )\
+                .where(conferences_users.c.conference == receiver)
+            query = insert(conversation_summaries).from_select(
+                ["user", "chat_type", "chat", *message, "read_seq", "unread"],
+                members
+            )
+        # Sender has read the whole chat, other members get one more unread
+        excluded = query.excluded
+        is_sender = summary.user == sender
+        query = query.on_conflict_do_update(
+            index_elements=[summary.user, summary.chat_type, summary.chat],
+            set_={
+                **{column: excluded[column] for column in message},
+                "read_seq": case(
+                    (is_sender, excluded.read_seq), else_=summary.read_seq
+                ),
+                "unread": case(
+                    (is_sender, excluded.unread),
+                    else_=summary.unread + excluded.unread
+                ),
+            }
+        )
+        await execute(query, session=session, fetch=False, commit=False)
+
 
 class User(Model):
     """
@@ -164,6 +363,15 @@ class User(Model):
     username = Column(Text, nullable=False, unique=True)
     name = Column(Text, nullable=True)
     surname = Column(Text, nullable=True)
+
+    # Lowercased username in bytewise order is searched by exact match and
+    #  prefix, and the same order is used to paginate results
+    search_key = func.lower(username).collate("C")
+
+    __table_args__ = (
+        Index("users_username_search", search_key),
+    )
+
     conferences = relationship(
         "Conference",
         secondary=conferences_users,
@@ -196,89 +404,90 @@ class User(Model):
     @with_session
     async def pm_overview(self, *, session: AsyncSession) -> Tuple:
         """
-        Gets a list of user's conversations with it's last messages.
+        Gets a list of user's conversations with its last messages ordered by
+        last activity.
         """
 
-        def ent_type(value):
-            return literal(value).label('type')
-        pms = select(
-                users_messages
-            )\
-            .select_from(users_messages)\
-            .join(Message, Message.id == users_messages.c.message)\
-            .where(not_(Message.deleted))\
-            .subquery()
-        pm = pms.c
-        cms = select(
-                conferences_messages.c.message,
-                conferences_messages.c.sender,
-                conferences_users.c.conference
+        summary = conversation_summaries.c
+        query = select(
+                summary.chat.label('interlocutor'),
+                summary.chat_type.label('type'),
+                func.coalesce(User.username, Conference.username)
+                    .label('username'),
+                summary.sender,
+                summary.preview,
+                summary.last_activity,
+                summary.unread,
             )\
-            .select_from(conferences_users)\
+            .select_from(conversation_summaries)\
             .outerjoin(
-                conferences_messages,
-                conferences_messages.c.conference == conferences_users.c.conference  # noqa
-            )\
-            .outerjoin(Message, Message.id == conferences_messages.c.message)\
-            .filter(
-                or_(not_(Message.deleted), conferences_messages.c.message.is_(None)),  # noqa
-                conferences_users.c.user == self.id
-            )\
-            .subquery()
-        cm = cms.c
-        interlocutor = case(
-                (pm.receiver == self.id, pm.sender),
-                else_=pm.receiver
-            ).label('interlocutor')
-        personal = select(
-                interlocutor,
-                func.max(pm.message).label('last_message'),
-                ent_type(1)
-            )\
-            .select_from(pms)\
-            .join(User, User.id == interlocutor)\
-            .filter(
-                or_(pm.sender == self.id, pm.receiver == self.id)
+                User, and_(summary.chat_type == 1, User.id == summary.chat)
             )\
-            .group_by('interlocutor')
-        personal_overview = select(
-                User.username,
-                personal.c.interlocutor,
-                personal.c.last_message,
-                pm.sender,
-                personal.c.type,
-            ).select_from(personal)\
-            .join(pms, pm.message == personal.c.last_message)\
-            .join(User, User.id == personal.c.interlocutor)
-        conference = select(
-                cm.conference.label('interlocutor'),
-                func.max(cm.message).label('last_message'),
-                ent_type(2)
-            )\
-            .select_from(cms)\
-            .group_by('interlocutor')
-        conference_overview = select(
-                Conference.username,
-                conference.c.interlocutor,
-                conference.c.last_message,
-                cm.sender,
-                conference.c.type,
-            ).select_from(conference)\
-            .outerjoin(cms, cm.message == conference.c.last_message)\
-            .join(Conference, Conference.id == conference.c.interlocutor)
-        conversations = union(
-            personal_overview, conference_overview
-        ).subquery()
-        conv = conversations.c
-        query = select(
-                Message,
-                conversations
+            .outerjoin(
+                Conference,
+                and_(summary.chat_type == 2, Conference.id == summary.chat)
             )\
-            .select_from(conversations)\
-            .outerjoin(Message, Message.id == conv.last_message)\
-            .order_by(Message.id.desc())
+            .where(summary.user == self.id)\
+            .order_by(summary.last_activity.desc())
         return await execute(query, session=session)
 
+    @with_session
+    async def read_chat(
+        self,
+        other: int,
+        chat_type: int = 1,
+        *,
+        session: AsyncSession
+    ):
+        """
+        Marks all chat's messages as read by user.
+        """
+
+        summary = conversation_summaries.c
+        query = update(conversation_summaries)\
+            .where(
+                summary.user == self.id,
+                summary.chat_type == chat_type,
+                summary.chat == other
+            )\
+            .values(
+                read_seq=func.coalesce(summary.last_seq, summary.read_seq),
+                unread=0
+            )
+        await execute(query, session=session, fetch=False)
+
+    @with_session
+    async def get_conferences_ids(
+        self,
+        *,
+        session: AsyncSession
+    ) -> List[int]:
+        """
+        Gets ids of conferences which user is a member of.
+        """
+
+        member = conferences_users.c
+        query = select(member.conference).where(member.user == self.id)
+        rows = await execute(query, session=session)
+        return [row.conference for row in rows]
+
+    @with_session
+    async def get_interlocutors_ids(
+        self,
+        *,
+        session: AsyncSession
+    ) -> List[int]:
+        """
+        Gets ids of users who have personal chats with user.
+        """
+
+        summary = conversation_summaries.c
+        query = select(summary.user).where(
+            and_(summary.chat_type == 1, summary.chat == self.id)
+        )
+        rows = await execute(query, session=session)
+        return [row.user for row in rows]
+
     @with_session
     async def get_personal_history(
         self,
@@ -286,96 +495,174 @@ class User(Model):
         offset: int,
         limit: int,
         *,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
         session: AsyncSession
     ) -> Tuple:
         """
         Gets a personal conversation history.
+
+        If 'before' or 'after' message number is given, messages are selected
+        by index range scan (newest first for 'before') and offset is ignored.
         """
 
         if isinstance(other, User):
             other = other.id
-        binding = users_messages.c
-        order_by = binding.message
-        reverse = offset < 0
-        if reverse:
+        return await self._get_history(
+            1, other, offset, limit,
+            before=before, after=after, session=session
+        )
+
+    @with_session
+    async def get_conversation_history(
+        self,
+        conference: Union[Conference, int],
+        offset: int,
+        limit: int,
+        *,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        session: AsyncSession
+    ) -> Tuple:
+        """
+        Gets a conference history.
+        """
+
+        if isinstance(conference, Conference):
+            conference = conference.id
+        return await self._get_history(
+            2, conference, offset, limit,
+            before=before, after=after, session=session
+        )
+
+    async def _get_history(
+        self,
+        chat_type: int,
+        other: int,
+        offset: int,
+        limit: int,
+        *,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        session: AsyncSession
+    ) -> Tuple:
+        bindings, binding_filter = chat_binding(chat_type, self.id, other)
+        binding = bindings.c
+        filters = [binding_filter, not_(Message.deleted)]
+        if before is not None:
+            offset = 0
+            filters.append(binding.seq < before)
+            ordering = binding.seq.desc()
+        elif after is not None:
+            offset = 0
+            filters.append(binding.seq > after)
+            ordering = binding.seq.asc()
+        elif offset < 0:
             offset = ~offset
-            ordering = order_by.desc()
+            ordering = binding.seq.desc()
         else:
-            ordering = order_by.asc()
-        message_number = func.row_number().over(order_by=binding.message)
-        external_id = message_number.label('external_id')
-        messages = select(
-                external_id,
-                users_messages
-            )\
-            .select_from(users_messages)\
-            .filter(
-                or_(
-                    and_(binding.sender == self.id, binding.receiver == other),
-                    and_(binding.sender == other, binding.receiver == self.id),
-                )
-            )\
-            .order_by(ordering)\
-            .subquery()
-        message = messages.c
-        query_ordering = message.external_id
-        if reverse:
-            query_ordering = query_ordering.desc()
+            ordering = binding.seq.asc()
         query = select(
                 Message,
-                message.sender,
-                message.external_id,
+                binding.sender,
+                binding.seq.label('external_id'),
             )\
-            .select_from(messages)\
-            .join(Message, Message.id == message.message)\
-            .filter(not_(Message.deleted))\
-            .limit(limit).offset(offset)\
-            .order_by(query_ordering)
+            .select_from(bindings)\
+            .join(Message, Message.id == binding.message)\
+            .filter(*filters)\
+            .order_by(ordering)\
+            .limit(limit).offset(offset)
         return await execute(query, session=session)
 
     @with_session
-    async def get_conversation_history(
+    async def search_messages(
         self,
-        conference: Union[Conference, int],
-        offset: int,
+        text: str,
         limit: int,
+        after: Optional[Tuple[float, int]] = None,
         *,
         session: AsyncSession
     ) -> Tuple:
-        binding = conferences_messages.c
-        order_by = binding.message
-        reverse = offset < 0
-        if reverse:
-            offset = ~offset
-            ordering = order_by.desc()
-        else:
-            ordering = order_by.asc()
-        message_number = func.row_number().over(order_by=binding.message)
-        external_id = message_number.label('external_id')
-        messages = select(
-                external_id,
-                conferences_messages
+        """
+        Finds messages of user's chats by full-text search query. Messages
+        are ordered by relevance.
+
+        Rows are (id, chat_type, chat, sender, seq, time_sent, rank, snippet),
+        rank and id of last row are position to get next page from ('after').
+        Snippet is message's raw text with found words put between
+        SNIPPET_START and SNIPPET_STOP characters.
+        """
+
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        matches = and_(
+            Message.search_vector.op("@@")(tsquery),
+            not_(Message.deleted)
+        )
+        rank = func.ts_rank(Message.search_vector, tsquery).label("rank")
+        pm = users_messages.c
+        personal = select(
+                Message.id,
+                literal_column("1").label("chat_type"),
+                case(
+                    (pm.sender == self.id, pm.receiver),
+                    else_=pm.sender
+                ).label("chat"),
+                pm.sender,
+                pm.seq,
+                Message.text,
+                Message.time_sent,
+                rank
             )\
-            .select_from(conferences_messages)\
-            .filter(
-                binding.conference == conference
+            .select_from(users_messages)\
+            .join(Message, Message.id == pm.message)\
+            .where(or_(pm.sender == self.id, pm.receiver == self.id), matches)
+        cm = conferences_messages.c
+        cu = conferences_users.c
+        conference = select(
+                Message.id,
+                literal_column("2").label("chat_type"),
+                cm.conference.label("chat"),
+                cm.sender,
+                cm.seq,
+                Message.text,
+                Message.time_sent,
+                rank
             )\
-            .order_by(ordering)\
-            .subquery()
-        message = messages.c
-        query_ordering = message.external_id
-        if reverse:
-            query_ordering = query_ordering.desc()
+            .select_from(conferences_messages)\
+            .join(conferences_users, and_(
+                cu.conference == cm.conference,
+                cu.user == self.id
+            ))\
+            .join(Message, Message.id == cm.message)\
+            .where(matches)
+        found = union_all(personal, conference).subquery()
+        page = select(found)\
+            .order_by(found.c.rank.desc(), found.c.id.desc())\
+            .limit(limit)
+        if after is not None:
+            page = page.where(
+                tuple_(found.c.rank, found.c.id) < tuple_(*after)
+            )
+        page = page.subquery()
+        # Snippets are costly, so they are made only for messages of the page
         query = select(
-                Message,
-                message.sender,
-                message.external_id,
+                page.c.id,
+                page.c.chat_type,
+                page.c.chat,
+                page.c.sender,
+                page.c.seq,
+                page.c.time_sent,
+                page.c.rank,
+                func.ts_headline(
+                    SEARCH_CONFIG,
+                    func.translate(
+                        page.c.text, SNIPPET_START + SNIPPET_STOP, ""
+                    ),
+                    tsquery,
+                    SNIPPET_OPTIONS
+                ).label("snippet")
             )\
-            .select_from(messages)\
-            .join(Message, Message.id == message.message)\
-            .filter(not_(Message.deleted))\
-            .limit(limit).offset(offset)\
-            .order_by(query_ordering)
+            .order_by(page.c.rank.desc(), page.c.id.desc())
         return await execute(query, session=session)
 
     @with_session
@@ -388,42 +675,50 @@ class User(Model):
         chat_type: int = 1,
         *,
         session: AsyncSession
-    ):
+    ) -> Optional[Tuple]:
         """
-        Updates a personal message.
+        Updates a user's message. Returns an updated message row or None if
+        chat has no such message sent by user.
         """
 
-        if chat_type == 1:
-            bindings = users_messages
-            binding_filter = or_(
-                and_(bindings.c.sender == self.id, bindings.c.receiver == other),  # noqa
-                and_(bindings.c.sender == other, bindings.c.receiver == self.id),  # noqa
-            )
-        elif chat_type == 2:
-            bindings = conferences_messages
-            binding_filter = (bindings.c.conference == other)
+        bindings, binding_filter = chat_binding(chat_type, self.id, other)
         binding = bindings.c
-        id = func.row_number().over(order_by=binding.message).label('id')
-        messages = select(
-                id,
-                Message.id.label('real_id')
-            )\
-            .select_from(bindings)\
-            .join(Message)\
-            .filter(
-                binding_filter
-            )\
-            .subquery()
+        # Message is addressed by chat's (conversation, seq) index and checked
+        #  for ownership by the same statement
         query = update(
                 Message
             )\
             .values(text=new_text, time_edit=dt.now())\
             .where(
-                messages.c.id == message_id,
-                messages.c.real_id == Message.id
+                binding_filter,
+                binding.seq == message_id,
+                binding.sender == self.id,
+                binding.message == Message.id,
+                not_(Message.deleted)
             )\
-            .execution_options(synchronize_session="fetch")
-        await execute(query, session=session, fetch=False)
+            .returning(
+                Message.id,
+                binding.seq,
+                binding.sender,
+                Message.text,
+                Message.time_sent,
+                Message.time_edit
+            )\
+            .execution_options(synchronize_session=False)
+        rows = await execute(query, session=session, commit=False)
+        if not rows:
+            return None
+        summary = conversation_summaries.c
+        await session.execute(
+            update(conversation_summaries)
+            .where(
+                chat_summaries(chat_type, self.id, other),
+                summary.last_seq == message_id
+            )
+            .values(preview=new_text[:PREVIEW_LENGTH])
+        )
+        await session.commit()
+        return rows[0]
 
     @with_session
     async def delete_pm(
@@ -433,42 +728,94 @@ class User(Model):
         chat_type: int = 1,
         *,
         session: AsyncSession
-    ):
+    ) -> Optional[Tuple]:
         """
-        Deletes a personal message.
+        Deletes a user's message. Returns a deleted message row or None if chat
+        has no such message sent by user.
         """
 
-        if chat_type == 1:
-            bindings = users_messages
-            binding_filter = or_(
-                and_(bindings.c.sender == self.id, bindings.c.receiver == other),  # noqa
-                and_(bindings.c.sender == other, bindings.c.receiver == self.id),  # noqa
-            )
-        elif chat_type == 2:
-            bindings = conferences_messages
-            binding_filter = (bindings.c.conference == other)
+        bindings, binding_filter = chat_binding(chat_type, self.id, other)
         binding = bindings.c
-        id = func.row_number().over(order_by=binding.message).label('id')
-        messages = select(
-                id,
-                Message.id.label('real_id')
-            )\
-            .select_from(bindings)\
-            .join(Message)\
-            .filter(
-                binding_filter
-            )\
-            .subquery()
         query = update(
                 Message
             )\
             .values(deleted=True)\
             .where(
-                messages.c.id == message_id,
-                messages.c.real_id == Message.id
+                binding_filter,
+                binding.seq == message_id,
+                binding.sender == self.id,
+                binding.message == Message.id,
+                not_(Message.deleted)
             )\
-            .execution_options(synchronize_session="fetch")
-        await execute(query, session=session, fetch=False)
+            .returning(Message.id, binding.seq, binding.sender)\
+            .execution_options(synchronize_session=False)
+        rows = await execute(query, session=session, commit=False)
+        if not rows:
+            return None
+        await self._unsummarize(chat_type, other, message_id, session=session)
+        await session.commit()
+        return rows[0]
+
+    async def _unsummarize(
+        self,
+        chat_type: int,
+        other: int,
+        message_id: int,
+        *,
+        session: AsyncSession
+    ) -> None:
+        """
+        Removes a deleted message from summaries of all chat's members.
+        """
+
+        bindings, binding_filter = chat_binding(chat_type, self.id, other)
+        binding = bindings.c
+        summary = conversation_summaries.c
+        summaries = chat_summaries(chat_type, self.id, other)
+        # Unread messages of member are the ones after it's read position
+        await session.execute(
+            update(conversation_summaries)
+            .where(
+                summaries,
+                summary.read_seq < message_id,
+                summary.unread > 0
+            )
+            .values(unread=summary.unread - 1)
+        )
+        # Previous message becomes the last one if deleted message was last
+        query = select(
+                binding.message,
+                binding.seq,
+                binding.sender,
+                Message.text,
+                Message.time_sent
+            )\
+            .select_from(bindings)\
+            .join(Message, Message.id == binding.message)\
+            .where(binding_filter, not_(Message.deleted))\
+            .order_by(binding.seq.desc())\
+            .limit(1)
+        rows = await execute(query, session=session, commit=False)
+        values = {
+            "last_message": None,
+            "last_seq": None,
+            "sender": None,
+            "preview": "",
+        }
+        if rows:
+            message, seq, sender, text, time_sent = rows[0]
+            values = {
+                "last_message": message,
+                "last_seq": seq,
+                "sender": sender,
+                "preview": text[:PREVIEW_LENGTH],
+                "last_activity": time_sent,
+            }
+        await session.execute(
+            update(conversation_summaries)
+            .where(summaries, summary.last_seq == message_id)
+            .values(**values)
+        )
 
     @classmethod
     @with_session
@@ -495,14 +842,64 @@ class User(Model):
     async def search(
         cls,
         username: str,
+        limit: int = SEARCH_LIMIT,
+        after: Optional[Tuple[int, str, int]] = None,
         *,
         session: AsyncSession
-    ) -> Tuple:
-        pattern = '%{}%'.format(username)
-        query = cls.filter(cls.username.like(pattern))
-        users = await session.execute(query)
-        users = tuple(users)
-        return users
+    ) -> list:
+        """
+        Finds users by part of username ignoring case. Exact match goes first,
+        then usernames starting with it and then other ones containing it.
+
+        Rows are (id, username, rank, key); rank and key of last row with its
+        id are position to get next page from ('after').
+        """
+
+        needle = username.lower()
+        escaped = needle.replace('\\', '\\\\')\
+            .replace('%', '\\%')\
+            .replace('_', '\\_')
+        key = cls.search_key
+        is_prefix = key.like(escaped + '%')
+        # Substrings are matched on plain lowercased username, which can be
+        #  covered by trigram index (see migration 4)
+        is_substring = func.lower(cls.username).like('%' + escaped + '%')
+        ranks = (
+            (0, key == needle),
+            (1, and_(is_prefix, key != needle)),
+            (2, and_(is_substring, not_(is_prefix))),
+        )
+        parts = []
+        for rank, condition in ranks:
+            if after is not None and rank < after[0]:
+                continue
+            conditions = [condition]
+            if after is not None and rank == after[0]:
+                _, after_key, after_id = after
+                conditions.append(or_(
+                    key > after_key,
+                    and_(key == after_key, cls.id > after_id)
+                ))
+            # Each part is limited on its own so it reads index only until
+            #  page is filled
+            parts.append(
+                select(
+                    cls.id,
+                    cls.username,
+                    literal_column(str(rank)).label("rank"),
+                    key.label("key")
+                )
+                .where(*conditions)
+                .order_by(key, cls.id)
+                .limit(limit)
+            )
+        if not parts:
+            return []
+        found = union_all(*parts).subquery()
+        query = select(found)\
+            .order_by(found.c.rank, found.c.key, found.c.id)\
+            .limit(limit)
+        return await execute(query, session=session)
 
     @with_session
     async def get_token(self, *, session: AsyncSession) -> str:
@@ -710,6 +1107,7 @@ class Conference(Model):
     id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(Text, nullable=False, unique=True)
     title = Column(Text)
+    last_seq = Column(Integer, nullable=False, server_default="0")
     users = relationship(
         "User",
         secondary=conferences_users,
@@ -730,14 +1128,26 @@ class Conference(Model):
         """
         session.add(self)
         await session.flush()
-        members = [conferences_users.insert().values(user=owner, conference=self.id, creator=True)]  # noqa
+        members = [{"user": owner, "conference": self.id, "creator": True}]
         members.extend(
-            conferences_users.insert().values(user=user, conference=self.id, creator=False)  # noqa
-            for user in users
+            {
+                "user": user.id if isinstance(user, User) else user,
+                "conference": self.id,
+                "creator": False
+            } for user in users
+        )
+        await execute(
+            conferences_users.insert().values(members),
+            session=session, fetch=False, commit=False
+        )
+        summaries = [
+            {"user": member["user"], "chat_type": 2, "chat": self.id}
+            for member in members
+        ]
+        await execute(
+            conversation_summaries.insert().values(summaries),
+            session=session, fetch=False, commit=False
         )
-        coros = [execute(query, session=session, fetch=False) for query in members]  # noqa
-        await asyncio.gather(*coros)
-        # await session.add_all(members)
         await session.commit()
 
 
@@ -789,11 +1199,13 @@ async def execute(
 ) -> Optional[Tuple]:
     """
     Executes given query. Fetch results and commits changes if otherwise
-    don't specified.
+    don't specified. SELECT queries and queries in read-only sessions are
+    never committed.
     """
 
     raw = await session.execute(query)
-    if commit:
+    read_only = session.info.get("read_only") or query.is_select
+    if commit and not read_only:
         await session.commit()
     if fetch:
         return raw.fetchall()
@@ -0,0 +1,132 @@
+"""
+Module for DB connection pool settings and telemetry.
+"""
+
+import time
+import weakref
+from time import perf_counter
+from typing import Optional
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .base import metadata
+
+
+# Pool settings defaults
+#  Most of API requests hold a connection for a few milliseconds, but every
+#  server-sent events stream reconnects often, so pool keeps a moderate number
+#  of persistent connections and allows bursts over it. Waiting for a
+#  connection is limited to fail fast instead of stalling all requests.
+#  Pre-ping is off: with asyncpg it runs 'SELECT 1' in a new transaction on
+#  every checkout (extra round trips) and that transaction isn't read-only,
+#  so stale connections are handled by recycling instead
+POOL_DEFAULTS = {
+    "size": 10,
+    "max_overflow": 20,
+    "timeout": 10,
+    "recycle": 1800,
+    "pre_ping": False,
+    "statement_cache_size": 256,
+    "pgbouncer": False,
+}
+
+
+class MonitoredPool(AsyncAdaptedQueuePool):
+    """
+    Connection pool which collects checkouts statistics.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.records = weakref.WeakSet()
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            record = super()._do_get()
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait_time = perf_counter() - start
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.checkouts += 1
+        return record
+
+    def _create_connection(self):
+        record = super()._create_connection()
+        self.records.add(record)
+        return record
+
+    def stats(self) -> dict:
+        """
+        Gets pool's current state and checkouts statistics (times are in
+        seconds).
+        """
+        now = time.time()
+        ages = [
+            now - record.starttime for record in self.records
+            if record.dbapi_connection is not None
+        ]
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_time": {
+                "avg": self.wait_time / self.checkouts if self.checkouts else 0,
+                "max": self.max_wait_time,
+            },
+            "connections": len(ages),
+            "connection_age": {
+                "avg": sum(ages) / len(ages) if ages else 0,
+                "max": max(ages, default=0),
+            },
+        }
+
+
+def engine_options(pool: dict) -> dict:
+    """
+    Converts pool settings from config to 'create_async_engine' options.
+    """
+
+    settings = dict(POOL_DEFAULTS, **pool)
+    connect_args = {
+        "prepared_statement_cache_size": settings["statement_cache_size"]
+    }
+    if settings["pgbouncer"]:
+        # PgBouncer in transaction mode may run next transaction of client on
+        #  other server connection, so statements can't be prepared once and
+        #  reused there
+        connect_args.update(
+            prepared_statement_cache_size=0,
+            statement_cache_size=0
+        )
+    return {
+        "poolclass": MonitoredPool,
+        "pool_size": settings["size"],
+        "max_overflow": settings["max_overflow"],
+        "pool_timeout": settings["timeout"],
+        "pool_recycle": settings["recycle"],
+        "pool_pre_ping": settings["pre_ping"],
+        "connect_args": connect_args,
+    }
+
+
+def pool_stats(engine: Optional[AsyncEngine] = None) -> dict:
+    """
+    Gets statistics of DB connection pool (of engine made by 'init' if other
+    is not given).
+    """
+
+    engine = engine or metadata.bind
+    return engine.sync_engine.pool.stats()
@@ -10,6 +10,7 @@ parser = ArgumentParser(description='MicroChat server')
 parser.add_argument('--config', dest='config', type=str, required=False, help='Path to config file')
 parser.add_argument('--gen-config', dest='gen_config', action='store_true', help='Generate config file?')
 parser.add_argument('--reformat-config', dest='reformat_config', action='store_true', help='Reformat config file?')
+parser.add_argument('--migrate', dest='migrate', action='store_true', help='Apply pending DB migrations and exit')
 
 args = parser.parse_args()
 
@@ -32,8 +33,26 @@ if args.gen_config:
             'host': '127.0.0.1',
             'port': 6543,
             'name': 'microchat',
+            'pool': {
+                'size': 10,
+                'max_overflow': 20,
+                'timeout': 10,
+                'recycle': 1800,
+                'pre_ping': False,
+                'statement_cache_size': 256,
+                'pgbouncer': False
+            },
             'options': {}
         },
+        'events': {
+            'queue_size': 256,
+            'policy': 'drop_oldest',
+            'replay_size': 128,
+            'replay_ttl': 300,
+            'presence_delay': 10,
+            'batch_window': 0,
+            'broker': 'memory'
+        },
     }
     if args.config:
         with open(args.config, 'w') as f:
@@ -103,3 +122,35 @@ port = str(DB_CONFIG.get('port', '6543'))
 database = DB_CONFIG.get('name', 'microchat')
 DB = f"{dbms}+{driver}://{user}:{password}@{domain}:{port}/{database}"
 DB_OPTIONS = DB_CONFIG.get('options', {})
+
+# Database connection pool settings
+#  size - number of persistent connections
+#  max_overflow - number of extra connections allowed under load
+#  timeout - seconds to wait for a free connection
+#  recycle - seconds after which a connection is reopened
+#  pre_ping - check connection liveness before use (costs a round trip)
+#  statement_cache_size - number of prepared statements cached per connection
+#  pgbouncer - compatibility with PgBouncer in transaction pooling mode
+#   (disables prepared statements caching)
+#  Omitted settings are taken from app.models.pool.POOL_DEFAULTS
+DB_POOL = DB_CONFIG.get('pool', {})
+
+# Events API settings
+#  queue_size - max number of events queued for one client
+#  policy - what to do when client's queue is full: 'drop_oldest',
+#   'coalesce' (drop events superseded by the new one) or 'disconnect' (tell
+#   client to resync and close its stream)
+#  replay_size - number of user's last events replayed to reconnected client
+#  replay_ttl - seconds for which events of disconnected user are kept
+#  presence_delay - seconds after which user without streams goes offline
+#  batch_window - seconds for which stream waits for more events after one
+#   arrives to write them at once (0 batches already queued events only)
+#  broker - 'memory' for single process or 'postgres' to deliver events to
+#   clients of all processes (and hosts) by DB notifications
+#  Omitted settings are taken from app.core.sse.LISTENER_DEFAULTS
+EVENTS_CONFIG = CONFIG.get('events', {})
+
+# Database migrations
+#  With '--migrate' flag pending migrations are applied and server isn't
+#  started, so schema can be upgraded ahead of deploy
+MIGRATE = args.migrate
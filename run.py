@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from aiohttp import web
@@ -5,7 +6,10 @@ from aiohttp_remotes import setup, XForwardedStrict
 from utils.fixes import fix_js_contenttype_header
 
 from app import get_app
+from app.models import init
+from app.models.migrations import schema_version
 from config import HOST, PORT
+from config import DB, DB_POOL, DB_OPTIONS, MIGRATE
 from config import PROXIFIED, PROXY_SUBNET
 from config import SERVE_STATIC, STATIC_PATH
 
@@ -32,5 +36,18 @@ async def app_factory() -> web.Application:
     return app
 
 
+async def migrate():
+    # Schema is upgraded by 'init' if it's behind the last version
+    engine = await init(DB, pool=DB_POOL, **DB_OPTIONS)
+    try:
+        version = await schema_version(engine)
+    finally:
+        await engine.dispose()
+    log.info(f"Database schema is up to date (version {version})")
+
+
 if __name__ == "__main__":
-    web.run_app(app_factory(), host=HOST, port=PORT)
+    if MIGRATE:
+        asyncio.run(migrate())
+    else:
+        web.run_app(app_factory(), host=HOST, port=PORT)
@@ -0,0 +1,8 @@
+import unittest
+
+from test import benchmarks
+
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(benchmarks)
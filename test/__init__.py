@@ -3,9 +3,14 @@ import unittest
 from .models import TestDBModels
 from .core import TestAppCore
 from .api import TestHTTPAPI
+from .benchmarks import TestQueryPlans, TestEventsLatency
 
 
 tests = unittest.TestSuite()
 tests.addTest(unittest.makeSuite(TestDBModels))
 tests.addTest(unittest.makeSuite(TestAppCore))
 tests.addTest(unittest.makeSuite(TestHTTPAPI))
+
+benchmarks = unittest.TestSuite()
+benchmarks.addTest(unittest.makeSuite(TestQueryPlans))
+benchmarks.addTest(unittest.makeSuite(TestEventsLatency))
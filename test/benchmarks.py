@@ -0,0 +1,360 @@
+import unittest
+import asyncio
+import json
+import logging
+import statistics
+from datetime import datetime as dt, timedelta
+from time import perf_counter
+
+from sqlalchemy.sql.expression import text
+
+from app.models import User
+from app.models import init, drop, metadata
+from app.models.migrations import MIGRATIONS
+from app.models.analytics import aggregate_activity, messages_stats
+from app.models.analytics import conferences_stats
+from app.api.sse.handlers import sse_api
+from app.core.events import MessageReceive
+
+from .misc import async_test, captured_statements
+from .models import db
+
+
+USERS = 2000
+DIALOGS = 1000
+PERSONAL_MESSAGES = 400000
+CONFERENCES = 20
+CONFERENCE_MESSAGES = 200000
+
+SEED = (
+    """
+    INSERT INTO users (username)
+    SELECT 'user' || i FROM generate_series(1, {users}) AS i
+    """,
+    """
+    INSERT INTO roles (title) VALUES ('member')
+    """,
+    """
+    INSERT INTO conferences (username, title)
+    SELECT 'conference' || i, 'Conference ' || i
+    FROM generate_series(1, {conferences}) AS i
+    """,
+    """
+    INSERT INTO conferences_users ("user", conference, creator)
+    SELECT u, c, u = c
+    FROM generate_series(1, {conferences}) AS c,
+         generate_series(1, 100) AS u
+    """,
+    """
+    INSERT INTO messages (text, time_sent, deleted)
+    SELECT 'message ' || i || ' topic' || i % 500,
+           now() - make_interval(secs => {total} - i),
+           i % 50 = 0
+    FROM generate_series(1, {total}) AS i
+    """,
+    """
+    INSERT INTO personal_messages (message, sender, receiver, seq)
+    SELECT i,
+           CASE WHEN i % 2 = 0 THEN 1 + i % {dialogs}
+                ELSE 1 + {dialogs} + i % {dialogs} END,
+           CASE WHEN i % 2 = 0 THEN 1 + {dialogs} + i % {dialogs}
+                ELSE 1 + i % {dialogs} END,
+           row_number() OVER (PARTITION BY i % {dialogs} ORDER BY i)
+    FROM generate_series(1, {personal}) AS i
+    """,
+    """
+    INSERT INTO conferences_messages (message, sender, conference, seq)
+    SELECT i, 1 + i % 100, 1 + i % {conferences},
+           row_number() OVER (PARTITION BY i % {conferences} ORDER BY i)
+    FROM generate_series({personal} + 1, {total}) AS i
+    """,
+    """
+    INSERT INTO dialogs_sequences (first_user, second_user, last_seq)
+    SELECT least(sender, receiver), greatest(sender, receiver), max(seq)
+    FROM personal_messages
+    GROUP BY least(sender, receiver), greatest(sender, receiver)
+    """,
+    """
+    UPDATE conferences SET last_seq = counters.last_seq
+    FROM (
+        SELECT conference, max(seq) AS last_seq
+        FROM conferences_messages GROUP BY conference
+    ) AS counters
+    WHERE conferences.id = counters.conference
+    """,
+    """
+    SELECT setval('messages_id_seq', {total})
+    """,
+)
+
+# Tables which must never be read with sequential scan by hot queries
+HOT_TABLES = {
+    "personal_messages", "conferences_messages", "conversation_summaries"
+}
+
+
+async def seed_database():
+    params = {
+        "users": USERS,
+        "dialogs": DIALOGS,
+        "conferences": CONFERENCES,
+        "personal": PERSONAL_MESSAGES,
+        "total": PERSONAL_MESSAGES + CONFERENCE_MESSAGES,
+    }
+    summaries = next(
+        migration for migration in MIGRATIONS
+        if migration.description == "conversations summaries"
+    )
+    async with metadata.bind.begin() as conn:
+        for statement in SEED:
+            await conn.execute(text(statement.format(**params)))
+        for statement in summaries.statements:
+            await conn.execute(text(statement))
+        await conn.execute(text("ANALYZE"))
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for subplan in plan.get("Plans", ()):
+        yield from plan_nodes(subplan)
+
+
+async def explain(statement: str, parameters) -> list:
+    parameters, inputsizes = parameters
+
+    def run_explain(sync_conn):
+        cursor = sync_conn.connection.cursor()
+        if inputsizes:
+            cursor.setinputsizes(*inputsizes)
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        return cursor.fetchone()[0]
+
+    async with metadata.bind.connect() as conn:
+        raw_plan = await conn.run_sync(run_explain)
+    if isinstance(raw_plan, str):
+        raw_plan = json.loads(raw_plan)
+    return list(plan_nodes(raw_plan[0]["Plan"]))
+
+
+class TestQueryPlans(unittest.TestCase):
+    """
+    Query plan regression benchmark: seeds a large dataset and checks that
+    hot queries read message binding tables and summaries by indexes.
+    """
+
+    repeats = 20
+
+    @classmethod
+    def setUpClass(cls):
+        logging.debug("Seeding benchmark dataset...")
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(init(db))
+        try:
+            loop.run_until_complete(seed_database())
+        except Exception:
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        async def cleanup():  # noqa
+            await drop(metadata)
+            await sse_api.stop()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(cleanup())
+
+    async def assertIndexScans(
+        self, name: str, coro_fn, tables=HOT_TABLES, index=None
+    ):
+        with captured_statements() as statements:
+            start = perf_counter()
+            for _ in range(self.repeats):
+                await coro_fn()
+            duration = (perf_counter() - start) / self.repeats
+        print("\n{}: {:.3f} ms".format(name, duration * 1000), end=" ")
+        queries = {
+            statement: parameters for statement, parameters in statements
+            if any(table in statement for table in tables)
+        }
+        self.assertTrue(queries, "{} executed no queries".format(name))
+        indexes = set()
+        for statement, parameters in queries.items():
+            for node in await explain(statement, parameters):
+                indexes.add(node.get("Index Name"))
+                relation = node.get("Relation Name")
+                if relation in tables:
+                    self.assertNotEqual(
+                        node["Node Type"], "Seq Scan",
+                        "{} reads {} sequentially:\n{}".format(
+                            name, relation, statement
+                        )
+                    )
+        if index is not None:
+            self.assertIn(
+                index, indexes, "{} doesn't use {}".format(name, index)
+            )
+
+    @async_test
+    async def test_personal_history_plan(self):
+        user = User(id=1)
+        await self.assertIndexScans(
+            "personal history (offset)",
+            lambda: user.get_personal_history(1 + DIALOGS, ~0, 100)
+        )
+        await self.assertIndexScans(
+            "personal history (keyset)",
+            lambda: user.get_personal_history(1 + DIALOGS, 0, 100, before=50)
+        )
+
+    @async_test
+    async def test_conference_history_plan(self):
+        user = User(id=1)
+        await self.assertIndexScans(
+            "conference history (offset)",
+            lambda: user.get_conversation_history(1, ~0, 100)
+        )
+        await self.assertIndexScans(
+            "conference history (keyset)",
+            lambda: user.get_conversation_history(1, 0, 100, before=5000)
+        )
+
+    @async_test
+    async def test_edit_and_delete_plan(self):
+        # All messages of this dialog are sent by user and not deleted
+        user = User(id=2 + DIALOGS)
+        await self.assertIndexScans(
+            "message edit",
+            lambda: user.update_pm(2, 10, "edited")
+        )
+        await self.assertIndexScans(
+            "message delete",
+            lambda: user.delete_pm(2, 11)
+        )
+
+    @async_test
+    async def test_overview_plan(self):
+        user = User(id=1)
+        await self.assertIndexScans(
+            "conversations overview",
+            lambda: user.pm_overview()
+        )
+
+    @async_test
+    async def test_user_search_plan(self):
+        await self.assertIndexScans(
+            "user search (exact and prefix)",
+            lambda: User.search("user1"),
+            tables={"users"}
+        )
+
+    @async_test
+    async def test_message_search_plan(self):
+        # Seeded messages contain topic words besides unique numbers, so
+        #  search vector statistics let planner estimate rare words
+        user = User(id=1)
+        await self.assertIndexScans(
+            "message search",
+            lambda: user.search_messages("12345", 20),
+            tables=HOT_TABLES | {"messages"}
+        )
+
+    @async_test
+    async def test_activity_plan(self):
+        start = perf_counter()
+        while await aggregate_activity(settle=timedelta(0)):
+            pass
+        print("\nactivity aggregation: {:.3f} s".format(
+            perf_counter() - start
+        ), end=" ")
+        # Rollups are made after seed's ANALYZE
+        async with metadata.bind.begin() as conn:
+            await conn.execute(text("ANALYZE activity_rollups"))
+        end = dt.now()
+        await self.assertIndexScans(
+            "hourly activity of a week",
+            lambda: messages_stats("hour", end - timedelta(days=7), end),
+            tables={"activity_rollups"}
+        )
+        # Ranking reads only buckets of its range
+        await self.assertIndexScans(
+            "conferences ranking of a day",
+            lambda: conferences_stats("hour", end - timedelta(days=1), end),
+            tables={"activity_rollups"},
+            index="activity_rollups_buckets"
+        )
+
+
+class TestEventsLatency(unittest.TestCase):
+
+    events = 2000
+
+    @classmethod
+    def setUpClass(cls):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(init(db))
+
+    @classmethod
+    def tearDownClass(cls):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(drop(metadata))
+
+    async def measure(self, queue) -> float:
+        """
+        Gets median time from making an event to its receiving by
+        listener's task (e.g. stream handler).
+        """
+        sent = {}
+        latencies = []
+        delivered = asyncio.Event()
+
+        async def listen():
+            while True:
+                event = await queue.get()
+                latencies.append(perf_counter() - sent[event.id])
+                delivered.set()
+
+        listener = asyncio.ensure_future(listen())
+        try:
+            for id in range(self.events):
+                delivered.clear()
+                sent[id] = perf_counter()
+                MessageReceive(1, 2, id, "text", 0, None, [])
+                await asyncio.wait_for(delivered.wait(), 1)
+        finally:
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+        return statistics.median(latencies)
+
+    @async_test
+    async def test_dispatch_latency(self):
+        queue = await sse_api.get_events_queue(2)
+        try:
+            direct = await self.measure(queue)
+            # Former path: handler's task puts event into queue of its type,
+            #  which is processed by another task
+            staged = asyncio.Queue()
+
+            async def stage(event):
+                staged.put_nowait(event)
+
+            async def process():
+                while True:
+                    sse_api.dispatch(await staged.get())
+
+            direct_handlers = MessageReceive.__direct_handlers__
+            MessageReceive.__direct_handlers__ = ()
+            MessageReceive.add_handler(stage)
+            processor = asyncio.ensure_future(process())
+            try:
+                queued = await self.measure(queue)
+            finally:
+                MessageReceive.__direct_handlers__ = direct_handlers
+                MessageReceive.__handlers__.discard(stage)
+                processor.cancel()
+                await asyncio.gather(processor, return_exceptions=True)
+        finally:
+            await sse_api.del_events_queue(2, queue)
+        print("\nevent delivery: {:.1f} us direct, {:.1f} us queued".format(
+            direct * 1000000, queued * 1000000
+        ), end=" ")
+        self.assertLess(direct, queued)
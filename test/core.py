@@ -1,5 +1,241 @@
 import unittest
+import asyncio
+import json
+from dataclasses import asdict, dataclass
+
+from utils.cache import TTLCache, cached
+from app.core.sse import ListenerQueue
+from app.core.events import MessageReceive, MessageEdit, MessageDelete
+from app.core.events import Resync, UserOnline, UserOffline
+from app.core.events.event_mixin import EventMixin
+
+from .misc import async_test
 
 
 class TestAppCore(unittest.TestCase):
-    pass
+
+    def test_ttl_cache(self):
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is the least recently used entry
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+        self.assertEqual((stats["size"], stats["evictions"]), (1, 1))
+
+    @async_test
+    async def test_cached_single_flight(self):
+        cache = TTLCache()
+        calls = []
+
+        @cached(cache)
+        async def load(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key * 2 if key else None
+
+        results = await asyncio.gather(load(1), load(1), load(2))
+        self.assertEqual(results, [2, 2, 4])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(await load(1), 2)
+        self.assertEqual(calls, [1, 2])
+        # None isn't cached
+        await load(0)
+        await load(0)
+        self.assertEqual(calls, [1, 2, 0, 0])
+        # Value loaded concurrently with invalidation isn't stored
+        task = asyncio.ensure_future(load(3))
+        await asyncio.sleep(0)
+        cache.invalidate((3,))
+        self.assertEqual(await task, 6)
+        self.assertEqual(cache.get((3,), "missing"), "missing")
+
+    @async_test
+    async def test_cached_caller_cancelled(self):
+        cache = TTLCache()
+        calls = []
+
+        @cached(cache)
+        async def load(key):
+            calls.append(key)
+            await asyncio.sleep(0.02)
+            return key * 2
+
+        first = asyncio.ensure_future(load(1))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(load(1))
+        await asyncio.sleep(0.005)
+        # Caller which started the call is gone, the call goes on for others
+        first.cancel()
+        self.assertEqual(await second, 2)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(calls, [1])
+        self.assertEqual(cache.get((1,)), 2)
+
+    @async_test
+    async def test_stale_while_revalidate(self):
+        now = [0.0]
+        cache = TTLCache(ttl=10, stale=20, clock=lambda: now[0])
+        calls = []
+
+        @cached(cache)
+        async def load(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        self.assertEqual(await load("a"), 1)
+        now[0] = 15
+        # Stale value is served while a single refresh runs
+        results = await asyncio.gather(load("a"), load("a"))
+        self.assertEqual(results, [1, 1])
+        await asyncio.sleep(0.02)
+        self.assertEqual(calls, ["a", "a"])
+        self.assertEqual(await load("a"), 2)
+        self.assertEqual(cache.stale_hits, 2)
+        # Too old value is loaded again
+        now[0] = 60
+        self.assertEqual(await load("a"), 3)
+
+    @async_test
+    async def test_listener_queue_policies(self):
+        def receive(id):
+            return MessageReceive(1, 2, id, "text", 0, None, [])
+
+        def edit(id, text):
+            return MessageEdit(2, 1, id, text, 0, [])
+
+        queue = ListenerQueue(1, 2, "drop_oldest")
+        for id in range(3):
+            queue.offer(receive(id))
+        self.assertEqual([queue.get_nowait().id for _ in range(2)], [1, 2])
+        self.assertEqual(queue.dropped, 1)
+
+        queue = ListenerQueue(1, 2, "coalesce")
+        queue.offer(receive(1))
+        queue.offer(edit(1, "first"))
+        # Previous edit of the same message is superseded
+        self.assertEqual(queue.offer(edit(1, "second")), 1)
+        self.assertEqual(queue.get_nowait().id, 1)
+        self.assertEqual(queue.get_nowait().text, "second")
+        queue.offer(receive(1))
+        queue.offer(receive(2))
+        # Nothing is superseded, so the oldest event is dropped
+        self.assertEqual(queue.offer(receive(3)), 1)
+        self.assertEqual(queue.get_nowait().id, 2)
+
+        queue = ListenerQueue(1, 2, "disconnect")
+        for id in range(3):
+            queue.offer(receive(id))
+        self.assertTrue(queue.closed)
+        self.assertEqual(queue.offer(receive(4)), 0)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertIsInstance(queue.get_nowait(), Resync)
+        self.assertEqual(queue.dropped, 3)
+
+    @async_test
+    async def test_listener_queue_waiting(self):
+        queue = ListenerQueue(1, 2, "drop_oldest")
+        getters = [asyncio.ensure_future(queue.get()) for _ in range(2)]
+        await asyncio.sleep(0)
+        # Each waiting getter gets its own event
+        queue.offer(MessageReceive(1, 2, 1, "text", 0, None, []))
+        queue.offer(MessageReceive(1, 2, 2, "text", 0, None, []))
+        events = await asyncio.wait_for(asyncio.gather(*getters), 1)
+        self.assertEqual(sorted(event.id for event in events), [1, 2])
+        self.assertTrue(queue.empty())
+        with self.assertRaises(asyncio.QueueEmpty):
+            queue.get_nowait()
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0.01)
+        self.assertFalse(getter.done())
+        getter.cancel()
+
+    @async_test
+    async def test_events_batching(self):
+        queue = ListenerQueue(1, 16, "drop_oldest", batch_window=0.02)
+        first = MessageReceive(1, 2, 1, "text", 0, None, [])
+        queue.offer(MessageEdit(2, 1, 1, "first", 0, []))
+
+        async def send_later():
+            await asyncio.sleep(0.005)
+            queue.offer(MessageReceive(1, 2, 2, "text", 0, None, []))
+            queue.offer(MessageEdit(2, 1, 1, "second", 0, []))
+            queue.offer(MessageEdit(2, 1, 2, "edit", 0, []))
+            queue.offer(MessageDelete(1, 2, 2))
+
+        sending = asyncio.ensure_future(send_later())
+        # Events arriving within the window are got with the first one
+        batch = await queue.batch(first)
+        await sending
+        self.assertEqual(
+            [(type(event), event.text) for event in batch[:2]],
+            [(MessageReceive, "text"), (MessageEdit, "second")]
+        )
+        # Deletion supersedes the message and its edit
+        self.assertIsInstance(batch[2], MessageDelete)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(queue.coalesced, 3)
+        self.assertTrue(queue.empty())
+
+    @async_test
+    async def test_handlers_errors(self):
+        @dataclass
+        class Probe(EventMixin):
+            value: int
+
+            __handlers__ = set()
+
+        received = []
+
+        def fail(event):
+            raise RuntimeError("direct")
+
+        async def fail_later(event):
+            raise RuntimeError("async")
+
+        Probe.add_direct_handler(fail)
+        Probe.add_direct_handler(received.append)
+        Probe.add_handler(fail_later)
+        with self.assertLogs("app.core.events.event_mixin", "ERROR") as logs:
+            Probe(1)
+            # Direct handlers are called before any task runs and failed
+            #  one doesn't stop others
+            self.assertEqual([event.value for event in received], [1])
+            await asyncio.sleep(0.01)
+        self.assertEqual(
+            [record.exc_info[1].args for record in logs.records],
+            [("direct",), ("async",)]
+        )
+
+    @async_test
+    async def test_presence_payload(self):
+        online = UserOnline(7, (1, 2, 3))
+        self.assertEqual(online.recipients, (1, 2, 3))
+        # Followers of user aren't sent to them
+        self.assertEqual(json.loads(online.as_json()), {"id": 7})
+        self.assertNotIn(b"followers", online.as_sse())
+        self.assertEqual(asdict(UserOffline(7, [1])), {"id": 7})
+
+    @async_test
+    async def test_event_encoded_once(self):
+        event = MessageReceive(1, 2, 3, "text", 0, None, [])
+        payload = event.as_sse()
+        self.assertIs(event.as_sse(), payload)
+        self.assertIs(event.as_json(), event.as_json())
+        fields, blank = payload.split(b"\r\n\r\n")
+        self.assertEqual(blank, b"")
+        name, data = fields.decode().split("\r\n")
+        self.assertEqual(name, "event: MessageReceive")
+        self.assertEqual(json.loads(data[len("data: "):]), asdict(event))
+        message = json.loads(event.as_ws())
+        self.assertEqual(message["event"], "MessageReceive")
+        self.assertEqual(message["data"], asdict(event))
+        self.assertIs(event.as_ws(), event.as_ws())
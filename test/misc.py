@@ -1,7 +1,10 @@
 import asyncio
+from contextlib import contextmanager
 
-from app.models import User, Message
-from app.models import new_session, store
+from sqlalchemy import event
+
+from app.models import User, Message, Role
+from app.models import new_session, store, metadata
 
 
 def async_to_sync(async_func):
@@ -19,8 +22,44 @@ def with_session(async_func):
     return wrapped
 
 
+@contextmanager
+def captured_statements():
+    """
+    Collects all statements (with parameters and their DB types) executed
+    inside the block. Transactions' begins and commits are collected as
+    'BEGIN' and 'COMMIT' statements, so a number of collected statements is
+    a number of round trips to DB.
+    """
+    statements = []
+    engine = metadata.bind.sync_engine
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        inputsizes = getattr(cursor, "_inputsizes", None)
+        statements.append((statement, (parameters, inputsizes)))
+
+    def capture_begin(conn):
+        statements.append(("BEGIN", None))
+
+    def capture_commit(conn):
+        statements.append(("COMMIT", None))
+
+    listeners = (
+        ("before_cursor_execute", capture),
+        ("begin", capture_begin),
+        ("commit", capture_commit),
+    )
+    for name, listener in listeners:
+        event.listen(engine, name, listener)
+    try:
+        yield statements
+    finally:
+        for name, listener in listeners:
+            event.remove(engine, name, listener)
+
+
 async def fill_database():
     await create_users()
+    await create_roles()
     await create_private_messages()
 
 
@@ -29,6 +68,11 @@ async def create_users():
     await store(*users)
 
 
+async def create_roles():
+    # Default role of conferences' members
+    await store(Role(title="member"))
+
+
 async def create_private_messages():
     pairs = (1, 2), (2, 1), (3, 2), (2, 3)
     for i in range(20):
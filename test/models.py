@@ -1,15 +1,38 @@
 import unittest
 import asyncio
+import json
 import logging
+import statistics
 import warnings
+from datetime import datetime as dt, timedelta
 
-# from sqlalchemy import exc
+from sqlalchemy import event, select, func, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
 
-from app.models import User, Message
-from app.models import init, drop, metadata
+from app.models import User, Message, File, Conference
+from app.models import init, drop, metadata, store, request_session
+from app.models import pool_stats
+from app.models.pool import engine_options
+from app.models.analytics import users_stats, aggregate_activity
+from app.models.analytics import messages_stats, conferences_stats
+from app.models.bindings import users_messages
+from app.models.models import execute
 from app.api.sse.handlers import sse_api
+from app.api.middlewares import cached_response, read_only
+from app.api.ws.handlers import perform
+from app.core import users
+from app.core.messages import create_conference, store_pm, search_pms
+from app.core.brokers import PostgresBroker, InMemoryBroker
+from app.core.events import UserChanged, MessageReceive, ChatCreate
+from app.core.events import Resync, UserOnline, UserOffline
+from app.core.events.events import PollingStart, PollingRequest, PollingEnd
+from app.core.sse import LISTENER_DEFAULTS
 
 from .misc import async_test, with_session, fill_database
+from .misc import captured_statements
 
 
 dbms = "postgresql"
@@ -69,6 +92,211 @@ class TestDBModels(unittest.TestCase):
     async def test_create_users(self, session):
         pass
 
+    @async_test
+    async def test_postgres_broker(self):
+        dsn = db.replace("+asyncpg", "")
+        types = {"MessageReceive": MessageReceive}
+        local, remote = [], []
+        publisher = PostgresBroker(local.append, dsn, types, "test_events")
+        subscriber = PostgresBroker(remote.append, dsn, types, "test_events")
+        await publisher.start()
+        await subscriber.start()
+        try:
+            # The last event doesn't fit into one notification
+            events = [
+                MessageReceive(1, 2, i, "text" * 1000 * i, 0, None, [])
+                for i in range(3)
+            ]
+            for event in events:
+                publisher.publish(event)
+            self.assertEqual(local, events)
+            for _ in range(100):
+                if len(remote) == len(events):
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(remote, events)
+            self.assertEqual(publisher.batches, 1)
+            self.assertEqual(subscriber.batches, 0)
+        finally:
+            await publisher.stop()
+            await subscriber.stop()
+
+    @async_test
+    async def test_remote_events_handling(self):
+        dsn = db.replace("+asyncpg", "")
+        types = {"UserChanged": UserChanged}
+        local, remote = [], []
+        publisher = PostgresBroker(local.append, dsn, types, "test_events")
+        subscriber = PostgresBroker(remote.append, dsn, types, "test_events")
+        await publisher.start()
+        await subscriber.start()
+        try:
+            users.users_cache.set(("username", "renamed"), "stale user")
+            # Event is made without local handlers, so only subscriber's
+            #  ones may drop the cached user
+            publisher.publish(UserChanged.restore({
+                "id": 0, "username": "renamed"
+            }))
+            for _ in range(100):
+                if remote:
+                    break
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+            self.assertEqual(remote[0].username, "renamed")
+            self.assertIsNone(
+                users.users_cache.invalidate(("username", "renamed"))
+            )
+        finally:
+            await publisher.stop()
+            await subscriber.stop()
+
+    @async_test
+    async def test_broker_event_types(self):
+        published = []
+        broker = sse_api.broker
+        sse_api.broker = InMemoryBroker(published.append)
+        try:
+            # Polling events are neither routed nor handled by other
+            #  processes, so they aren't sent to them
+            await PollingStart.emit(0)
+            await PollingRequest.emit(0, "1")
+            await PollingEnd.emit(0, 0)
+            self.assertEqual(published, [])
+            online = UserOnline(0, ())
+            self.assertEqual(published, [online])
+        finally:
+            sse_api.broker = broker
+
+    @async_test
+    async def test_socket_requests(self):
+        sender, receiver = await store(
+            User(username="socket_sender"), User(username="socket_receiver")
+        )
+
+        async def request(id, action, **data):
+            return await perform(sender.id, json.dumps({
+                "id": id, "action": action, "data": data
+            }))
+
+        sent = await request(1, "send", to=receiver.id, text="socket")
+        self.assertEqual((sent["id"], sent["status"]), (1, 0))
+        history = await request("2", "get", user_id=receiver.id, count=10)
+        self.assertEqual(history["id"], "2")
+        messages = history["result"]["messages"]
+        self.assertEqual(
+            [(m["id"], m["text"]) for m in messages],
+            [(sent["result"]["id"], "socket")]
+        )
+        failed = await request(3, "send", to=receiver.id, text=" ")
+        self.assertEqual(failed["error"], "ValueError")
+        unknown = await perform(sender.id, "{}")
+        self.assertEqual(unknown["description"], "unknown action")
+
+    @async_test
+    async def test_events_replay(self):
+        sender, user = await store(
+            User(username="replay_sender"), User(username="replay_user")
+        )
+
+        async def send(text):
+            await MessageReceive.emit(sender.id, user.id, text, [], 1, 1)
+            await asyncio.sleep(0.01)
+
+        queue = await sse_api.get_events_queue(user.id)
+        await send("first")
+        received = queue.get_nowait()
+        self.assertIn(
+            "id: {}".format(received.event_id).encode(), received.as_sse()
+        )
+        await sse_api.del_events_queue(user.id, queue)
+        # Events sent while client is away are replayed after reconnect
+        await send("second")
+        await send("third")
+        queue = await sse_api.get_events_queue(
+            user.id, str(received.event_id)
+        )
+        replayed = [queue.get_nowait() for _ in range(queue.qsize())]
+        self.assertEqual([e.text for e in replayed], ["second", "third"])
+        self.assertLess(received.event_id, replayed[0].event_id)
+        # Too old events aren't kept anymore
+        resumed = await sse_api.get_events_queue(user.id, "1")
+        self.assertIsInstance(resumed.get_nowait(), Resync)
+        self.assertFalse(resumed.closed)
+        await sse_api.del_events_queue(user.id, queue)
+        await sse_api.del_events_queue(user.id, resumed)
+
+    @async_test
+    async def test_presence(self):
+        sse_api.configure(presence_delay=0.05)
+        self.addCleanup(
+            sse_api.configure,
+            presence_delay=LISTENER_DEFAULTS["presence_delay"]
+        )
+        user, follower = await store(
+            User(username="present_user"), User(username="follower")
+        )
+        async with request_session():
+            await store_pm(follower.id, user.id, "hi", [], 1)
+        self.assertEqual(await user.get_interlocutors_ids(), [follower.id])
+        watcher = await sse_api.get_events_queue(follower.id)
+        try:
+            await asyncio.sleep(0.1)
+            while not watcher.empty():
+                watcher.get_nowait()
+
+            queue = await sse_api.get_events_queue(user.id)
+            await asyncio.sleep(0.1)
+            online = watcher.get_nowait()
+            self.assertIsInstance(online, UserOnline)
+            self.assertEqual(online.id, user.id)
+            # Followers are routing data, clients get only user's id
+            self.assertEqual(json.loads(online.as_json()), {"id": user.id})
+            self.assertIn(user.id, sse_api.online)
+            # Reconnects within presence delay aren't announced
+            for _ in range(3):
+                await sse_api.del_events_queue(user.id, queue)
+                queue = await sse_api.get_events_queue(user.id)
+            await asyncio.sleep(0.1)
+            self.assertTrue(watcher.empty())
+            await sse_api.del_events_queue(user.id, queue)
+            await asyncio.sleep(0.1)
+            offline = watcher.get_nowait()
+            self.assertIsInstance(offline, UserOffline)
+            self.assertEqual(offline.id, user.id)
+            self.assertNotIn(user.id, sse_api.online)
+        finally:
+            await sse_api.del_events_queue(follower.id, watcher)
+            # Follower goes offline before other tests
+            await asyncio.sleep(0.1)
+        self.assertNotIn(follower.id, sse_api.online)
+
+    @async_test
+    async def test_long_polling(self):
+        sender, user = await store(
+            User(username="poll_sender"), User(username="poll_user")
+        )
+        # Nothing to get: poll waits and ends empty
+        events, cursor = await sse_api.poll(user.id, timeout=0.05)
+        self.assertEqual(events, [])
+        # Events sent between polls are got by cursor
+        for text in "first", "second":
+            await MessageReceive.emit(sender.id, user.id, text, [], 1, 1)
+        await asyncio.sleep(0.01)
+        events, next_cursor = await sse_api.poll(user.id, str(cursor), 1)
+        self.assertEqual([e.text for e in events], ["first", "second"])
+        self.assertEqual(next_cursor, events[-1].event_id)
+        # Parked poll is answered as soon as event arrives
+
+        async def send_later():
+            await asyncio.sleep(0.05)
+            await MessageReceive.emit(sender.id, user.id, "third", [], 1, 1)
+
+        sending = asyncio.ensure_future(send_later())
+        events, cursor = await sse_api.poll(user.id, str(next_cursor), 5)
+        await sending
+        self.assertEqual([e.text for e in events], ["third"])
+        self.assertFalse(sse_api.listener_queues.get(user.id))
+
     @async_test
     @with_session
     async def test_getting_object(self, session):
@@ -112,3 +340,424 @@ class TestDBModels(unittest.TestCase):
             }
             m = Message(text="test{}".format(i))
             await m.bind(**params)
+
+    @async_test
+    async def test_keyset_pagination(self):
+        user = User(id=1)
+        page = await user.get_personal_history(2, 0, 4, before=11)
+        self.assertEqual([mid for _, _, mid in page], [10, 9, 8, 7])
+        page = await user.get_personal_history(2, 0, 4, before=page[-1][2])
+        self.assertEqual([mid for _, _, mid in page], [6, 5, 4, 3])
+        page = await user.get_personal_history(2, 0, 4, after=8)
+        self.assertEqual([mid for _, _, mid in page], [9, 10])
+
+    @async_test
+    async def test_message_numbering(self):
+        ids = []
+        for i in range(3):
+            m = Message(text="numbering{}".format(i))
+            sender, receiver = (4, 5) if i % 2 else (5, 4)
+            ids.append(await m.bind(sender=sender, receiver=receiver))
+        self.assertEqual(ids, [1, 2, 3], "Messages numbered not sequentially")
+        user = User(id=4)
+        messages = await user.get_personal_history(
+            other=5, offset=0, limit=100
+        )
+        self.assertEqual([mid for _, _, mid in messages], ids)
+
+    @async_test
+    async def test_conversation_summaries(self):
+        sender, receiver = await store(
+            User(username="summary_sender"),
+            User(username="summary_receiver")
+        )
+        for text in "first", "second":
+            message = Message(text=text)
+            await message.bind(sender=sender.id, receiver=receiver.id)
+
+        async def summary(user, other):
+            rows = await user.pm_overview()
+            return next(row for row in rows if row.interlocutor == other.id)
+        chat = await summary(receiver, sender)
+        self.assertEqual((chat.preview, chat.unread), ("second", 2))
+        chat = await summary(sender, receiver)
+        self.assertEqual((chat.preview, chat.unread), ("second", 0))
+        await sender.update_pm(receiver.id, 2, "edited")
+        chat = await summary(receiver, sender)
+        self.assertEqual((chat.preview, chat.unread), ("edited", 2))
+        await sender.delete_pm(receiver.id, 2)
+        chat = await summary(receiver, sender)
+        self.assertEqual((chat.preview, chat.unread), ("first", 1))
+        await receiver.read_chat(sender.id)
+        chat = await summary(receiver, sender)
+        self.assertEqual((chat.preview, chat.unread), ("first", 0))
+
+    @async_test
+    async def test_message_ownership(self):
+        owner, other = await store(
+            User(username="ownership_owner"),
+            User(username="ownership_other")
+        )
+        message = Message(text="original")
+        await message.bind(sender=owner.id, receiver=other.id)
+        self.assertIsNone(await other.update_pm(owner.id, 1, "forged"))
+        self.assertIsNone(await other.delete_pm(owner.id, 1))
+        edited = await owner.update_pm(other.id, 1, "edited")
+        self.assertEqual((edited.seq, edited.sender), (1, owner.id))
+        self.assertEqual(edited.text, "edited")
+        self.assertTrue(edited.time_edit)
+        deleted = await owner.delete_pm(other.id, 1)
+        self.assertEqual((deleted.seq, deleted.sender), (1, owner.id))
+        self.assertIsNone(await owner.delete_pm(other.id, 1))
+        self.assertFalse(await owner.get_personal_history(other.id, 0, 10))
+
+    @async_test
+    async def test_user_search(self):
+        await store(*(
+            User(username=username) for username in (
+                "my_Finder", "Finder", "FINDER_two", "finder2", "finderXtwo"
+            )
+        ))
+        found = await User.search("finder")
+        self.assertEqual(
+            [user.username for user in found],
+            ["Finder", "finder2", "FINDER_two", "finderXtwo", "my_Finder"]
+        )
+        self.assertEqual(
+            [user.rank for user in found], [0, 1, 1, 1, 2]
+        )
+        # Pages continue each other across ranks
+        first = await User.search("finder", 2)
+        last = first[-1]
+        second = await User.search("finder", 3, (last.rank, last.key, last.id))
+        self.assertEqual(list(first) + list(second), list(found))
+        # LIKE wildcards are matched literally
+        found = await User.search("r_t")
+        self.assertEqual([user.username for user in found], ["FINDER_two"])
+
+    @async_test
+    async def test_message_search(self):
+        first, second, stranger = await store(
+            User(username="search_first"),
+            User(username="search_second"),
+            User(username="search_stranger")
+        )
+        texts = (
+            "Lunch at noon?", "LUNCH lunch lunch", "meeting moved", "lunch"
+        )
+        for text in texts:
+            await Message(text=text).bind(sender=first.id, receiver=second.id)
+        await Message(text="lunch").bind(
+            sender=stranger.id, receiver=1
+        )
+        found = await second.search_messages("lunch", 10)
+        self.assertEqual([row.seq for row in found][0], 2)
+        self.assertEqual(sorted(row.seq for row in found), [1, 2, 4])
+        self.assertEqual(
+            {(row.chat_type, row.chat) for row in found}, {(1, first.id)}
+        )
+        self.assertIn("\x02Lunch\x03", found[-1].snippet)
+        # Snippets are escaped, only marks of found words are HTML
+        await Message(text="x<y & \x02brunch").bind(
+            sender=second.id, receiver=first.id
+        )
+        found, _ = await search_pms(first.id, "brunch", 10)
+        self.assertEqual(
+            found[0]["snippet"], "x&lt;y &amp; <mark>brunch</mark>"
+        )
+        # Search vector follows edits
+        await first.update_pm(second.id, 3, "lunch meeting moved")
+        self.assertEqual(len(await first.search_messages("lunch", 10)), 4)
+        self.assertFalse(await first.search_messages("moved -lunch", 10))
+        # Pages continue each other
+        pages = []
+        after = None
+        while True:
+            page = await first.search_messages("lunch", 3, after)
+            pages.extend(row.id for row in page)
+            if len(page) < 3:
+                break
+            after = (page[-1].rank, page[-1].id)
+        self.assertEqual(
+            pages, [row.id for row in await first.search_messages("lunch", 9)]
+        )
+
+    @async_test
+    async def test_users_cache(self):
+        user, = await store(User(username="cached"))
+        users.users_cache.clear()
+        with captured_statements() as statements:
+            resolved = await users.resolve("cached")
+            self.assertEqual(resolved.id, user.id)
+            self.assertIs(await users.resolve("cached"), resolved)
+            by_id = await users.get_by_id(user.id, 1)
+            self.assertIs(await users.get_by_id(user.id, 1), by_id)
+        queries = [s for s, _ in statements if s not in ("BEGIN", "COMMIT")]
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(users.users_cache.hits, 2)
+        # Rename drops both user's entries
+        await UserChanged.emit(user.id, "cached")
+        await asyncio.sleep(0.01)
+        self.assertFalse(len(users.users_cache))
+
+    @async_test
+    async def test_cached_response(self):
+        calls = []
+
+        @cached_response(ttl=10)
+        @read_only
+        async def handler(request):
+            calls.append(request.rel_url.path_qs)
+            rows = await execute(select(func.count()).select_from(User))
+            return web.json_response({"users": rows[0][0]})
+
+        self.assertTrue(handler.without_session)
+        responses = await asyncio.gather(*(
+            handler(make_mocked_request("GET", path))
+            for path in ("/stats?a=1", "/stats?a=1", "/stats?a=2")
+        ))
+        self.assertEqual(calls, ["/stats?a=1", "/stats?a=2"])
+        self.assertEqual(responses[0].body, responses[1].body)
+        self.assertEqual(responses[0].content_type, "application/json")
+        await handler(make_mocked_request("GET", "/stats?a=1"))
+        self.assertEqual(len(calls), 2)
+
+    @async_test
+    async def test_conference_fan_out(self):
+        owner, member, other = await store(
+            User(username="fan_out_owner"),
+            User(username="fan_out_member"),
+            User(username="fan_out_other")
+        )
+        conference = Conference(username="fan_out")
+        await conference.create(owner.id, [member.id])
+        member_queue = await sse_api.get_events_queue(member.id)
+        other_queue = await sse_api.get_events_queue(other.id)
+
+        async def receive(queue):
+            return await asyncio.wait_for(queue.get(), 1)
+
+        await MessageReceive.emit(owner.id, conference.id, "hi", [], 2, 1)
+        event = await receive(member_queue)
+        self.assertEqual((event.receiver, event.text), (conference.id, "hi"))
+        self.assertTrue(other_queue.empty())
+        # Members of new conference are indexed by its creation event
+        created = await create_conference(
+            "fan_out_new", owner.id, [other.id], 2
+        )
+        event = await receive(other_queue)
+        self.assertIsInstance(event, ChatCreate)
+        self.assertEqual(sse_api.conference_listeners[created], {other.id})
+        await MessageReceive.emit(owner.id, created, "new", [], 2, 1)
+        self.assertEqual((await receive(other_queue)).text, "new")
+        self.assertTrue(member_queue.empty())
+        # Users without streams stay indexed until replay TTL passes
+        sse_api.configure(replay_ttl=0)
+        self.addCleanup(sse_api.configure, replay_ttl=300)
+        await sse_api.del_events_queue(member.id, member_queue)
+        await sse_api.del_events_queue(other.id, other_queue)
+        self.assertNotIn(conference.id, sse_api.conference_listeners)
+        self.assertNotIn(other.id, sse_api.listener_conferences)
+
+    @async_test
+    async def test_users_stats(self):
+        pm = users_messages.c
+        sent = dict(await execute(
+            select(pm.sender, func.count()).group_by(pm.sender)
+        ))
+        received = dict(await execute(
+            select(pm.receiver, func.count()).group_by(pm.receiver)
+        ))
+        with captured_statements() as statements:
+            stats = await users_stats()
+        self.assertFalse(any(
+            "personal_messages" in statement for statement, _ in statements
+        ))
+        exact = {
+            row.User.id: (row.sended, row.received) for row in stats["exact"]
+        }
+        # Users who only sent or only received messages aren't counted
+        self.assertEqual(exact, {
+            user: (sent[user], received[user])
+            for user in sent.keys() & received.keys()
+        })
+        general = stats["general"]
+        self.assertEqual(
+            general.sended_med,
+            statistics.median(sended for sended, _ in exact.values())
+        )
+        self.assertEqual(
+            general.received_med,
+            statistics.median(received for _, received in exact.values())
+        )
+
+    @async_test
+    async def test_activity_rollups(self):
+        async def aggregate():
+            while await aggregate_activity(settle=timedelta(0)):
+                pass
+
+        async def today(*args):
+            start = dt.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=1)
+            rows = await messages_stats("day", start, end, *args)
+            return rows[0] if rows else None
+
+        await aggregate()
+        before = await today()
+        owner, member = await store(
+            User(username="rollups_owner"), User(username="rollups_member")
+        )
+        conference = Conference(username="rollups")
+        await conference.create(owner.id, [member.id])
+        file, = await store(File(name="rollups", size=100))
+        await Message(text="first").bind(
+            owner.id, conference.id, chat_type=2, attachments=[file.id]
+        )
+        await Message(text="second").bind(owner.id, conference.id, chat_type=2)
+        await Message(text="personal").bind(member.id, owner.id)
+        await aggregate()
+        await aggregate()
+        rollup = await today(2, conference.id)
+        self.assertEqual(
+            (rollup.messages, rollup.attachments, rollup.attachments_size),
+            (2, 1, 100)
+        )
+        self.assertEqual(rollup.active_users, 1)
+        after = await today()
+        if before is not None:
+            self.assertEqual(after.messages - before.messages, 3)
+            self.assertEqual(after.uploads - before.uploads, 1)
+            self.assertEqual(after.uploads_size - before.uploads_size, 100)
+        start = dt.now() - timedelta(days=1)
+        ranking = await conferences_stats("day", start, dt.now())
+        self.assertIn(
+            (conference.id, 2),
+            [(row.id, row.messages) for row in ranking]
+        )
+
+    @async_test
+    async def test_rollups_backlog_batches(self):
+        while await aggregate_activity(settle=timedelta(0)):
+            pass
+        owner, = await store(User(username="backlog_owner"))
+        conference = Conference(username="backlog")
+        await conference.create(owner.id, [])
+        ids = []
+        for i in range(4):
+            message = Message(text=str(i))
+            await message.bind(owner.id, conference.id, chat_type=2)
+            ids.append(message.id)
+        # Backlog of an old day takes several batches
+        day = (dt.now() - timedelta(days=10)).replace(
+            hour=12, minute=0, second=0, microsecond=0
+        )
+        async with metadata.bind.begin() as conn:
+            await conn.execute(
+                update(Message).where(Message.id.in_(ids))
+                .values(time_sent=day)
+            )
+        batches = 0
+        while await aggregate_activity(batch=2, settle=timedelta(0)):
+            batches += 1
+        self.assertGreater(batches, 1)
+        start = day.replace(hour=0)
+        rollup, = await messages_stats(
+            "day", start, start + timedelta(days=1), 2, conference.id
+        )
+        self.assertEqual((rollup.messages, rollup.active_users), (4, 1))
+
+    @async_test
+    async def test_message_sending_round_trips(self):
+        sender, receiver = await store(
+            User(username="round_trips_sender"),
+            User(username="round_trips_receiver")
+        )
+        files = await store(*(File(name=str(i)) for i in range(3)))
+        message = Message(text="with attachments")
+        with captured_statements() as statements:
+            await message.bind(
+                sender=sender.id,
+                receiver=receiver.id,
+                attachments=[file.id for file in files]
+            )
+        # BEGIN, message, binding, summaries, attachments and COMMIT
+        self.assertEqual(len(statements), 6, "\n".join(s for s, _ in statements))  # noqa
+        self.assertEqual([s for s, _ in statements].count("COMMIT"), 1)
+        rows = await receiver.get_personal_history(sender.id, 0, 10)
+        attachments = rows[0].Message.attachments
+        self.assertEqual(
+            [(a.file_id, a.position) for a in attachments],
+            [(file.id, i) for i, file in enumerate(files)]
+        )
+
+    @async_test
+    async def test_request_session(self):
+        user = User(id=1)
+        checkouts = []
+        pool = metadata.bind.sync_engine.pool
+
+        def checkout(dbapi_connection, record, proxy):
+            checkouts.append(record)
+        event.listen(pool, "checkout", checkout)
+        try:
+            with captured_statements() as statements:
+                async with request_session(read_only=True):
+                    await User.resolve("1")
+                    await user.get_personal_history(2, 0, 10)
+                    await user.pm_overview()
+        finally:
+            event.remove(pool, "checkout", checkout)
+        statements = [statement for statement, _ in statements]
+        self.assertEqual(len(checkouts), 1, "Connection checked out again")
+        self.assertEqual(statements.count("BEGIN"), 1)
+        self.assertNotIn("COMMIT", statements)
+        with self.assertRaises(DBAPIError):
+            async with request_session(read_only=True):
+                await Message(text="read only").bind(sender=1, receiver=2)
+        async with request_session():
+            await user.read_chat(2)
+            await Message(text="read write").bind(sender=1, receiver=2)
+        rows = await user.get_personal_history(2, ~0, 1)
+        self.assertEqual(rows[0].Message.text, "read write")
+
+    @async_test
+    async def test_pool_stats(self):
+        before = pool_stats()
+        await User(id=1).pm_overview()
+        stats = pool_stats()
+        self.assertEqual(stats["checkouts"], before["checkouts"] + 1)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertGreaterEqual(stats["connections"], 1)
+        self.assertGreater(stats["connection_age"]["max"], 0)
+        self.assertGreaterEqual(stats["wait_time"]["max"], 0)
+
+    def test_pgbouncer_options(self):
+        options = engine_options({"statement_cache_size": 50})
+        self.assertEqual(options["connect_args"], {
+            "prepared_statement_cache_size": 50
+        })
+        options = engine_options({"pgbouncer": True})
+        self.assertEqual(options["connect_args"], {
+            "prepared_statement_cache_size": 0,
+            "statement_cache_size": 0
+        })
+
+    @async_test
+    async def test_startup_skips_ddl(self):
+        # Engine is made by 'init' itself, so all engines are listened
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        previous = metadata.bind
+        event.listen(Engine, "before_cursor_execute", capture)
+        try:
+            engine = await init(db)
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+        await previous.dispose()
+        self.assertIs(metadata.bind, engine)
+        self.assertEqual(len(statements), 1)
+        self.assertIn("schema_versions", statements[0])
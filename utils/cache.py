@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+from typing import Tuple
+
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache which entries expire after 'ttl' seconds. Counts hits
+    and misses (expired entry is a miss).
+
+    Expired entries are kept for 'stale' more seconds and can be got by
+    'lookup' while their new values are loaded.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+        stale: float = 0.0
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        self.clock = clock
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Incremented by every invalidation, so values loaded before it can be
+        #  recognized as stale ones
+        self.generation = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value, fresh = self._find(key)
+        if fresh:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def lookup(self, key: Hashable) -> Tuple[Any, bool]:
+        """
+        Gets a value and whether it's fresh (not expired). Returns MISSING
+        if there is no value or it's expired more than 'stale' seconds ago.
+        """
+        value, fresh = self._find(key)
+        if fresh:
+            self.hits += 1
+        elif value is not MISSING:
+            self.stale_hits += 1
+        else:
+            self.misses += 1
+        return value, fresh
+
+    def _find(self, key: Hashable) -> Tuple[Any, bool]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING, False
+        expires, value = entry
+        now = self.clock()
+        if expires + self.stale <= now:
+            del self.entries[key]
+            return MISSING, False
+        self.entries.move_to_end(key)
+        return value, expires > now
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> Any:
+        """
+        Drops an entry. Returns its value (None if there was no entry).
+        """
+        _, value = self.entries.pop(key, (None, None))
+        self.generation += 1
+        return value
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.generation += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        """
+        Gets cache's size and hits/misses counters.
+        """
+        served = self.hits + self.stale_hits
+        requests = served + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "stale": self.stale,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": served / requests if requests else 0,
+        }
+
+
+def cached(
+    cache: TTLCache,
+    key: Optional[Callable[..., Hashable]] = None
+) -> Callable:
+    """
+    Caches results of coroutine function in given cache. Concurrent calls
+    with the same key which missed cache share one call of function.
+
+    Key is made from call's arguments by 'key' function (arguments tuple by
+    default). None results aren't cached.
+
+    Function is called in its own task, so a cancelled caller (e.g. handler
+    of closed connection) doesn't cancel it for other callers.
+
+    If cache keeps stale values, stale value is returned at once and a single
+    background call refreshes it (stale-while-revalidate).
+    """
+
+    def make_key(*args, **kwargs) -> Hashable:
+        return args + tuple(sorted(kwargs.items()))
+
+    key = key or make_key
+
+    def wrapper(coro: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        pending: Dict[Hashable, asyncio.Task] = {}
+        refreshes: Set[asyncio.Task] = set()
+
+        @wraps(coro)
+        async def wrapped(*args, **kwargs):
+            cache_key = key(*args, **kwargs)
+            value, fresh = cache.lookup(cache_key)
+            if fresh:
+                return value
+            if cache_key in pending:
+                if value is not MISSING:
+                    return value
+                return await asyncio.shield(pending[cache_key])
+            if value is not MISSING:
+                refresh = load(cache_key, args, kwargs)
+                refreshes.add(refresh)
+                refresh.add_done_callback(refreshed)
+                return value
+            return await asyncio.shield(load(cache_key, args, kwargs))
+
+        def refreshed(refresh: asyncio.Task) -> None:
+            refreshes.discard(refresh)
+            if not refresh.cancelled() and refresh.exception() is not None:
+                logger.error(
+                    "Refresh of %s failed", coro.__qualname__,
+                    exc_info=refresh.exception()
+                )
+
+        def load(cache_key: Hashable, args, kwargs) -> asyncio.Task:
+            # Call is registered at once, before it's task is started
+            task = asyncio.ensure_future(
+                fill(cache_key, cache.generation, args, kwargs)
+            )
+            pending[cache_key] = task
+            return task
+
+        async def fill(
+            cache_key: Hashable,
+            generation: int,
+            args,
+            kwargs
+        ) -> Any:
+            try:
+                value = await coro(*args, **kwargs)
+            finally:
+                pending.pop(cache_key, None)
+            # Value loaded concurrently with invalidation may be stale
+            if value is not None and generation == cache.generation:
+                cache.set(cache_key, value)
+            return value
+
+        wrapped.cache = cache
+        return wrapped
+
+    return wrapper
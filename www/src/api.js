@@ -45,6 +45,8 @@ var api = {
 		send: castRequester("/api/messages/send", "POST"),
 		edit: castRequester("/api/messages/edit", "POST"),
 		delete: castRequester("/api/messages/delete", "POST"),
+		read: castRequester("/api/messages/read", "POST"),
+		search: castRequester("/api/messages/search", "POST"),
 		create_conversation: castRequester("/api/messages/create_conversation", "POST"),
 	},
 	users: {
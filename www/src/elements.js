@@ -120,8 +120,7 @@ const entryBox = {
 	},
 	render_query_results: (results) => {
 		let container = document.createElement('div');
-		for (let [uid, username] of Object.entries(results)) {
-			if (uid=='ok') continue;
+		for (let [uid, username] of results) {
 			let entry = createElement('div', { classList: ['search-message-container', 'border-bottom-gray'] });
 			let avatar = createElement('div', { classList: ['avatar_mini', 'search-message-avatar'] });
 			let uname = createElement('h4', { class: 'search-message-sender' });
@@ -95,6 +95,11 @@ async function mainloop() {
 		}
 		console.log(e);
 	})
+	// Some events were dropped: chats are reloaded, stream is reconnected
+	//  by browser
+	eventSource.addEventListener('Resync', e => {
+		api.messages.overview().then(entryBox.render_messages);
+	})
 };
 
 searchForm.addEventListener('submit', search_user);